@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Move old messages out of the ``messages`` table into compressed archives.
+
+    python archive.py run                 # à lancer chaque nuit (Heroku Scheduler)
+    python archive.py history <user_id>   # historique complet, archives comprises
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import aliased
+
+from database import Session, Message, MessageArchive
+from history_cache import HISTORY_TURNS
+
+logger = logging.getLogger(__name__)
+
+# Âge à partir duquel un message quitte la table chaude
+MESSAGE_RETENTION_DAYS = int(os.getenv('MESSAGE_RETENTION_DAYS', 180))
+# Messages déplacés par transaction, et pause entre deux transactions
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', 1000))
+ARCHIVE_CHUNK_PAUSE = float(os.getenv('ARCHIVE_CHUNK_PAUSE', 0.1))
+
+USAGE_COLUMNS = ('prompt_tokens', 'cached_prompt_tokens', 'completion_tokens')
+
+def to_record(msg) -> dict:
+    record = {
+        'id': msg.id,
+        'is_sent_by_user': msg.is_sent_by_user,
+        'message': msg.message,
+        'created_at': msg.created_at.isoformat() if msg.created_at else None,
+    }
+    record.update({column: getattr(msg, column) for column in USAGE_COLUMNS})
+    return record
+
+def compress(records) -> bytes:
+    lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+    return gzip.compress(lines.encode('utf-8'))
+
+def decompress(data: bytes) -> list:
+    return [json.loads(line) for line in gzip.decompress(data).decode('utf-8').splitlines()]
+
+def archive_chunk(session, cutoff, chunk_size: int) -> int:
+    """Archive the next ``chunk_size`` old messages in one transaction. Returns how many."""
+    # Les HISTORY_TURNS derniers messages de chaque utilisateur restent : le bot
+    # y lit le contexte envoyé à OpenAI, même après une longue absence.
+    recent = aliased(Message)
+    first_kept = (
+        select(recent.id)
+        .where(recent.user_id == Message.user_id)
+        .order_by(recent.id.desc())
+        .offset(HISTORY_TURNS - 1)
+        .limit(1)
+        .scalar_subquery()
+    )
+    messages = session.execute(
+        select(Message)
+        .where(Message.created_at < cutoff, Message.id < func.coalesce(first_kept, 0))
+        .order_by(Message.id)
+        .limit(chunk_size)
+    ).scalars().all()
+    if not messages:
+        return 0
+
+    groups = defaultdict(list)
+    for msg in messages:
+        groups[(msg.user_id, msg.created_at.strftime('%Y-%m'))].append(msg)
+    for (user_id, month), group in groups.items():
+        session.add(MessageArchive(
+            user_id=user_id,
+            month=month,
+            first_message_id=group[0].id,
+            last_message_id=group[-1].id,
+            message_count=len(group),
+            data=compress(to_record(msg) for msg in group),
+        ))
+    session.execute(delete(Message).where(Message.id.in_([msg.id for msg in messages])))
+    session.commit()
+    return len(messages)
+
+def archive_old_messages(retention_days: int = MESSAGE_RETENTION_DAYS, chunk_size: int = ARCHIVE_CHUNK_SIZE,
+                         pause: float = ARCHIVE_CHUNK_PAUSE) -> int:
+    """Archive every message older than ``retention_days``, chunk by chunk.
+
+    Each user's HISTORY_TURNS latest messages stay, however old.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    total = 0
+    while True:
+        session = Session()
+        try:
+            archived = archive_chunk(session, cutoff, chunk_size)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        total += archived
+        if archived < chunk_size:
+            break
+        logger.info("%s messages archived so far", total)
+        # Laisse passer les écritures du bot entre deux lots
+        time.sleep(pause)
+    logger.info("%s messages older than %s archived", total, cutoff)
+    return total
+
+def read_history(session, user_id) -> list:
+    """Return every message of the user as dicts, archived ones first, oldest first."""
+    archives = session.execute(
+        select(MessageArchive).filter_by(user_id=user_id).order_by(MessageArchive.first_message_id)
+    ).scalars().all()
+    records = [record for archive in archives for record in decompress(archive.data)]
+    recent = session.execute(select(Message).filter_by(user_id=user_id).order_by(Message.id)).scalars().all()
+    records.extend(to_record(msg) for msg in recent)
+    return records
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="archive the messages older than the retention period")
+    run.add_argument('--days', type=int, default=MESSAGE_RETENTION_DAYS)
+    run.add_argument('--chunk-size', type=int, default=ARCHIVE_CHUNK_SIZE)
+    history = commands.add_parser('history', help="print a user's full history as JSONL")
+    history.add_argument('user_id', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        archive_old_messages(args.days, args.chunk_size)
+    else:
+        with Session() as session:
+            for record in read_history(session, args.user_id):
+                sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    main()
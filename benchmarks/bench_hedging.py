@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Compare time to first token with and without hedged completions.
+
+The fake OpenAI server answers the main model slowly now and then (tail
+latency) and the fallback model quickly, so no API key is needed:
+
+    python benchmarks/bench_hedging.py --requests 200 --tail-ratio 0.1 --tail-latency 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_openai import FakeOpenAI
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+async def measure(openai_client, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            reply = openai_client.stream_response([], "Hello")
+            await reply.__anext__()
+            timings.append(time.perf_counter() - start)
+            await reply.aclose()
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return timings
+
+async def run(args):
+    fake = FakeOpenAI(
+        first_token_latency=args.latency,
+        model_latencies={args.fallback_model: args.fallback_latency},
+        tail_ratio=args.tail_ratio,
+        tail_latency=args.tail_latency,
+    )
+    os.environ['OPENAI_BASE_URL'] = await fake.start()
+    os.environ.setdefault('OPEN_AI_KEY', 'fake')
+    os.environ['FALLBACK_MODEL'] = args.fallback_model
+
+    import openai_client
+
+    results = {}
+    for hedging in (False, True):
+        openai_client.OPENAI_HEDGING = hedging
+        fake.chat_models.clear()
+        timings = await measure(openai_client, args.requests, args.concurrency)
+        results[hedging] = (timings, dict(fake.chat_models))
+
+    await openai_client.close()
+    await fake.stop()
+
+    print(f"time to first token over {args.requests} requests ({args.tail_ratio:.0%} with +{args.tail_latency}s)")
+    for hedging, (timings, models) in results.items():
+        label = "hedged" if hedging else "single"
+        print(f"  {label}: p50 {percentile(timings, 50) * 1000:6.0f} ms  p95 {percentile(timings, 95) * 1000:6.0f} ms"
+              f"  p99 {percentile(timings, 99) * 1000:6.0f} ms  requests {models}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.5, help="first-token latency of the main model (s)")
+    parser.add_argument('--fallback-model', default='gpt-4o-mini')
+    parser.add_argument('--fallback-latency', type=float, default=0.3)
+    parser.add_argument('--tail-ratio', type=float, default=0.1)
+    parser.add_argument('--tail-latency', type=float, default=5.0)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
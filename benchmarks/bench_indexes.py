@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Time the hot queries on a seeded SQLite database, without and with indexes.
+
+    python benchmarks/bench_indexes.py --users 2000 --messages-per-user 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, User, Message, Subscription
+
+INDEXES = [index for table in Base.metadata.sorted_tables for index in table.indexes]
+
+def seed(engine, users, messages_per_user):
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        connection.execute(insert(User), [
+            {'user_id': user_id, 'username': f'user{user_id}', 'stripe_customer_id': f'cus_{user_id}', 'message_count': 0}
+            for user_id in range(1, users + 1)
+        ])
+        rows = []
+        for user_id in range(1, users + 1):
+            for i in range(messages_per_user):
+                rows.append({
+                    'user_id': user_id,
+                    'message': 'x' * random.randint(20, 400),
+                    'is_sent_by_user': i % 2 == 0,
+                    'created_at': now - timedelta(minutes=messages_per_user - i),
+                })
+        # Messages interleaved across users, as they arrive in production
+        random.shuffle(rows)
+        connection.execute(insert(Message), rows)
+        connection.execute(insert(Subscription), [
+            {'user_id': user_id, 'start_date': now, 'end_date': now + timedelta(days=30), 'created_at': now}
+            for user_id in range(1, users + 1, 5)
+        ])
+
+def run_queries(Session, user_ids):
+    timings = {}
+
+    def timed(name, query):
+        start = time.perf_counter()
+        with Session() as session:
+            for user_id in user_ids:
+                query(session, user_id)
+        timings[name] = (time.perf_counter() - start) / len(user_ids) * 1000
+
+    timed('count sent messages', lambda s, u: s.query(Message).filter_by(user_id=u, is_sent_by_user=True).count())
+    timed('recent history', lambda s, u: s.query(Message).filter_by(user_id=u).order_by(Message.created_at.desc()).limit(6).all())
+    timed('latest subscription', lambda s, u: s.query(Subscription).filter_by(user_id=u).order_by(Subscription.created_at.desc()).first())
+    timed('user by stripe customer', lambda s, u: s.query(User).filter_by(stripe_customer_id=f'cus_{u}').first())
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages-per-user', type=int, default=200)
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        for index in INDEXES:
+            index.drop(engine)
+
+        print(f"Seeding {args.users} users x {args.messages_per_user} messages...")
+        seed(engine, args.users, args.messages_per_user)
+        Session = sessionmaker(bind=engine)
+        user_ids = random.sample(range(1, args.users + 1), min(args.samples, args.users))
+
+        before = run_queries(Session, user_ids)
+        for index in INDEXES:
+            index.create(engine)
+        after = run_queries(Session, user_ids)
+
+    print(f"{'query':<26}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for name in before:
+        print(f"{name:<26}{before[name]:>14.3f}{after[name]:>14.3f}{before[name] / after[name]:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""Load-test the bot and the Stripe web app end to end against local fakes.
+
+Runs the real handlers (through ``main.build_application`` and its webhook)
+and the ``stripe_checkout`` routes against benchmarks/fake_telegram.py,
+fake_openai.py and fake_stripe.py, on a fresh SQLite database by default.
+Each simulated user sends /start then text and voice messages, waiting for
+each reply; at the paywall a share of them pay (checkout redirect then a
+signed ``invoice.paid`` webhook) and keep chatting.
+
+    python benchmarks/bench_load.py --users 50 --turns 12 --voice-ratio 0.3
+    python benchmarks/bench_load.py --json after.json --baseline before.json
+
+SQLite needs ``aiosqlite``; pass ``--database-url`` and ``--async-database-url``
+to run against a local MySQL instead. The bot's settings are read from the
+environment as usual (STREAM_REPLIES, VOICE_PIPELINE...); the OpenAI account
+limits are lifted unless OPENAI_RPM / OPENAI_TPM are set.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_openai import FakeOpenAI
+from fake_stripe import FakeStripe
+from fake_telegram import FakeTelegram
+
+BOT_TOKEN = '123456:fake-token'
+WEBHOOK_SECRET = 'whsec_fake'
+
+MESSAGES = [
+    "I have had a really stressful week at work.",
+    "I can't sleep well lately, my mind keeps racing at night.",
+    "My manager criticised my work in front of everyone today.",
+    "How can I stop procrastinating on the things that matter?",
+    "I feel lonely since I moved to a new city.",
+]
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class Stats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def error(self, stage):
+        self.errors[stage] += 1
+
+    def summary(self):
+        return {
+            stage: {
+                'count': len(values),
+                'p50': percentile(values, 50) * 1000,
+                'p95': percentile(values, 95) * 1000,
+                'p99': percentile(values, 99) * 1000,
+                'max': max(values) * 1000,
+            }
+            for stage, values in sorted(self.samples.items())
+        }
+
+class LoadTest:
+    def __init__(self, args, telegram, stripe_fake, application, web_app):
+        self.args = args
+        self.telegram = telegram
+        self.stripe_fake = stripe_fake
+        self.application = application
+        self.web_app = web_app
+        self.stats = Stats()
+        self.random = random.Random(args.seed)
+        # update_id -> future résolue quand le handler a fini
+        self.pending = {}
+        self.turns = 0
+        from quota import PAYWALL_TEXT
+        self.paywall_text = PAYWALL_TEXT
+
+        for handler in application.handlers[0]:
+            handler.callback = self._completion(handler.callback)
+
+    def _completion(self, callback):
+        async def wrapper(update, context):
+            try:
+                await callback(update, context)
+            except Exception:
+                self.stats.error('handler')
+                raise
+            finally:
+                future = self.pending.pop(update.update_id, None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+        return wrapper
+
+    def _paywall(self, sent):
+        return any(entry['message'].get('text') == self.paywall_text for entry in sent)
+
+    async def turn(self, kind, update):
+        """Push ``update`` and wait for its handler; returns what the bot sent meanwhile."""
+        chat_id = update['message']['chat']['id']
+        future = asyncio.get_running_loop().create_future()
+        self.pending[update['update_id']] = future
+        start = time.perf_counter()
+        await self.telegram.push_update(update)
+        acked = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(update['update_id'], None)
+            self.stats.error(f'{kind}.turn')
+            return []
+        finished = time.perf_counter()
+        sent = [entry for entry in self.telegram.sent_to(chat_id) if start <= entry['time'] <= finished]
+
+        if self._paywall(sent):
+            kind = 'paywall'
+        self.turns += 1
+        self.stats.add('telegram.webhook_ack', acked - start)
+        self.stats.add(f'{kind}.turn', finished - start)
+        first_method = 'sendVoice' if kind == 'voice' else 'sendMessage'
+        first = next((entry for entry in sent if entry['method'] == first_method), None)
+        if first is not None:
+            self.stats.add(f'{kind}.first_reply', first['time'] - start)
+        return sent
+
+    async def pay(self, user_id) -> bool:
+        from sqlalchemy import select
+        from database import AsyncSession, Subscription
+
+        client = self.web_app.test_client()
+        start = time.perf_counter()
+        response = await asyncio.to_thread(client.get, f'/redirect_to_stripe?user_id={user_id}')
+        self.stats.add('checkout.redirect', time.perf_counter() - start)
+        if response.status_code != 302 or 'checkout.stripe.test' not in response.headers.get('Location', ''):
+            self.stats.error('checkout.redirect')
+            return False
+
+        # Second clic sur « Continue chatting » : même session de paiement
+        start = time.perf_counter()
+        again = await asyncio.to_thread(client.get, f'/redirect_to_stripe?user_id={user_id}')
+        self.stats.add('checkout.redirect_again', time.perf_counter() - start)
+        if again.headers.get('Location') != response.headers.get('Location'):
+            self.stats.error('checkout.redirect_again')
+
+        payload = self.stripe_fake.invoice_paid_event(self.stripe_fake.customers[str(user_id)])
+        headers = {'Stripe-Signature': self.stripe_fake.sign(payload), 'Content-Type': 'application/json'}
+        start = time.perf_counter()
+        response = await asyncio.to_thread(client.post, '/webhook', data=payload, headers=headers)
+        self.stats.add('webhook.ack', time.perf_counter() - start)
+        if response.status_code != 200:
+            self.stats.error('webhook.ack')
+            return False
+
+        # L'événement est appliqué en arrière-plan : attendu en base, comme le bot le verra.
+        # Le tour suivant vérifie ensuite que le paywall est bien levé.
+        deadline = start + self.args.timeout
+        while time.perf_counter() < deadline:
+            async with AsyncSession() as session:
+                subscription = await session.scalar(select(Subscription.id).filter_by(user_id=user_id).limit(1))
+            if subscription is not None:
+                self.stats.add('webhook.applied', time.perf_counter() - start)
+                return True
+            await asyncio.sleep(0.01)
+        self.stats.error('webhook.applied')
+        return False
+
+    async def user(self, user_id):
+        await asyncio.sleep(self.random.uniform(0, self.args.ramp_up))
+        await self.turn('start', self.telegram.text_update(user_id, '/start'))
+        paid = False
+        for _ in range(self.args.turns):
+            if self.random.random() < self.args.voice_ratio:
+                sent = await self.turn('voice', self.telegram.voice_update(user_id))
+            else:
+                sent = await self.turn('text', self.telegram.text_update(user_id, self.random.choice(MESSAGES)))
+            if self._paywall(sent):
+                if paid:
+                    self.stats.error('paywall.after_payment')
+                    return
+                if self.random.random() >= self.args.pay_ratio:
+                    return
+                paid = await self.pay(user_id)
+                if not paid:
+                    return
+            await asyncio.sleep(self.random.uniform(0, self.args.think_time))
+
+    async def run(self):
+        start = time.perf_counter()
+        await asyncio.gather(*(self.user(100000 + i) for i in range(self.args.users)))
+        return time.perf_counter() - start
+
+def report(args, stats, elapsed, turns):
+    summary = stats.summary()
+    print(f"{args.users} users, {turns} turns in {elapsed:.1f}s: {turns / elapsed:.1f} turns/s")
+    print(f"{'stage':24} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, values in summary.items():
+        print(f"{stage:24} {values['count']:6d} {values['p50']:9.0f} {values['p95']:9.0f} {values['p99']:9.0f} {values['max']:9.0f}")
+    for stage, count in sorted(stats.errors.items()):
+        print(f"errors in {stage}: {count}")
+
+    results = {
+        'config': vars(args),
+        'elapsed': elapsed,
+        'turns': turns,
+        'throughput': turns / elapsed,
+        'stages': summary,
+        'errors': dict(stats.errors),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nthroughput: {baseline['throughput']:.1f} -> {results['throughput']:.1f} turns/s")
+        for stage, values in summary.items():
+            before = baseline['stages'].get(stage)
+            if before:
+                change = (values['p95'] - before['p95']) / before['p95'] * 100 if before['p95'] else 0.0
+                print(f"  {stage:24} p95 {before['p95']:8.0f} -> {values['p95']:8.0f} ms ({change:+.0f}%)")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='bench_load_')
+    telegram = FakeTelegram(send_latency=args.telegram_latency)
+    openai_fake = FakeOpenAI(first_token_latency=args.openai_latency, transcription_latency=args.openai_latency)
+    stripe_fake = FakeStripe(WEBHOOK_SECRET, api_latency=args.stripe_latency)
+    telegram_url = await telegram.start()
+    openai_url = await openai_fake.start()
+    stripe_url = await stripe_fake.start()
+
+    database_path = os.path.join(workdir, 'bench.db')
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_BASE_URL': telegram_url,
+        'OPENAI_BASE_URL': openai_url,
+        'OPEN_AI_KEY': 'fake',
+        'STRIPE_API_KEY': 'sk_test_fake',
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'FREE_MESSAGE_LIMIT': str(args.free_messages),
+        'TTS_CACHE_DIR': os.path.join(workdir, 'tts'),
+        'DATABASE_URL': args.database_url or f"sqlite:///{database_path}",
+        'ASYNC_DATABASE_URL': args.async_database_url or f"sqlite+aiosqlite:///{database_path}",
+    })
+    os.environ.setdefault('OPENAI_RPM', '1000000')
+    os.environ.setdefault('OPENAI_TPM', '100000000')
+
+    # Importés après la configuration : les modules lisent l'environnement au chargement
+    import stripe
+    import main
+    from database import Base, get_engine
+    from stripe_checkout import create_app
+
+    stripe.api_base = stripe_url
+    Base.metadata.create_all(get_engine())
+    web_app = create_app()
+
+    application = main.build_application()
+    load_test = LoadTest(args, telegram, stripe_fake, application, web_app)
+    port = free_port()
+    await application.initialize()
+    await application.updater.start_webhook(
+        listen='127.0.0.1', port=port, url_path='telegram',
+        webhook_url=f"http://127.0.0.1:{port}/telegram", allowed_updates=main.ALLOWED_UPDATES,
+    )
+    await application.start()
+    try:
+        elapsed = await load_test.run()
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await telegram.stop()
+        await openai_fake.stop()
+        await stripe_fake.stop()
+
+    report(args, load_test.stats, elapsed, load_test.turns)
+    print(f"\nOpenAI requests: {openai_fake.requests}, Stripe requests: {stripe_fake.requests}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=10, help="messages sent by each user after /start")
+    parser.add_argument('--voice-ratio', type=float, default=0.3)
+    parser.add_argument('--pay-ratio', type=float, default=0.5, help="share of users paying at the paywall")
+    parser.add_argument('--free-messages', type=int, default=5)
+    parser.add_argument('--think-time', type=float, default=1.0, help="max pause between two messages of a user (s)")
+    parser.add_argument('--ramp-up', type=float, default=2.0, help="users start within this delay (s)")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--stripe-latency', type=float, default=0.3)
+    parser.add_argument('--database-url')
+    parser.add_argument('--async-database-url')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare with results written by a previous --json run")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Measure the cold start of the web app and the bot worker.
+
+Each run starts a fresh interpreter that imports the module and builds the
+app, as gunicorn and `python main.py` do. The database host is unroutable,
+so any connection made at startup shows up as a stall. ``--compare REF``
+measures another revision too, from a temporary git worktree:
+
+    python benchmarks/bench_startup.py --runs 5 --compare HEAD~1
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+TARGETS = {
+    'web': "import stripe_checkout; getattr(stripe_checkout, 'create_app', lambda: stripe_checkout.app)()",
+    'worker': "import main; getattr(main, 'build_application', lambda: None)()",
+}
+
+ENVIRONMENT = {
+    'DATABASE_USER': 'bench',
+    'DATABASE_PASSWORD': 'bench',
+    'DATABASE_HOST': '10.255.255.1',
+    'DATABASE_PORT': '3306',
+    'DATABASE_NAME': 'bench',
+    'TELEGRAM_BOT_TOKEN': '123456:fake-token',
+    'OPEN_AI_KEY': 'fake',
+    'STRIPE_API_KEY': 'sk_test_fake',
+}
+
+def measure(directory, code, runs, timeout):
+    env = {**os.environ, **ENVIRONMENT}
+    for name in ('DATABASE_URL', 'ASYNC_DATABASE_URL'):
+        env.pop(name, None)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        try:
+            subprocess.run([sys.executable, '-c', code], cwd=directory, env=env, check=True, timeout=timeout,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired:
+            return None
+        except subprocess.CalledProcessError as e:
+            print(e.stderr.decode(errors='replace').strip().splitlines()[-1], file=sys.stderr)
+            return None
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def report(label, directory, args):
+    for target, code in TARGETS.items():
+        median = measure(directory, code, args.runs, args.timeout)
+        result = f"{median * 1000:8.0f} ms" if median is not None else f"  failed or over {args.timeout:.0f}s"
+        print(f"  {label:10} {target:7} {result}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--compare', metavar='REF', help="git revision to measure as well")
+    args = parser.parse_args()
+
+    print(f"median cold start over {args.runs} runs")
+    report('current', ROOT, args)
+    if args.compare:
+        with tempfile.TemporaryDirectory() as directory:
+            worktree = os.path.join(directory, 'tree')
+            subprocess.run(['git', 'worktree', 'add', '--detach', worktree, args.compare], cwd=ROOT, check=True,
+                           stdout=subprocess.DEVNULL)
+            try:
+                report(args.compare, worktree, args)
+            finally:
+                subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=ROOT, check=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Compare time-to-first-audio of the sequential and pipelined voice replies.
+
+Runs against benchmarks/fake_openai.py, so no API key is needed:
+
+    python benchmarks/bench_voice_pipeline.py --runs 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_openai import FakeOpenAI
+
+async def run(runs):
+    fake = FakeOpenAI()
+    os.environ['OPENAI_BASE_URL'] = await fake.start()
+    os.environ.setdefault('OPEN_AI_KEY', 'fake')
+
+    import openai_client
+    from voice_pipeline import speak_pipelined
+
+    sequential, pipelined = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        reply = await openai_client.generate_response([], "Hello")
+        await openai_client.create_speech(reply)
+        sequential.append(time.perf_counter() - start)
+
+        first_audio = []
+
+        async def send_voice(audio):
+            if not first_audio:
+                first_audio.append(time.perf_counter())
+
+        start = time.perf_counter()
+        await speak_pipelined(openai_client.stream_response([], "Hello"), send_voice)
+        pipelined.append(first_audio[0] - start)
+
+    await openai_client.close()
+    await fake.stop()
+
+    print(f"time to first audio over {runs} runs (median)")
+    print(f"  sequential: {statistics.median(sequential) * 1000:8.0f} ms")
+    print(f"  pipelined:  {statistics.median(pipelined) * 1000:8.0f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args.runs))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Local stand-in for the OpenAI endpoints the bot uses, with injected latency.
+
+Point the bot at it with ``OPENAI_BASE_URL=http://127.0.0.1:<port>/v1``.
+``model_latencies`` overrides the first-token latency per model, and a
+``tail_ratio`` share of the chat requests take ``tail_latency`` more.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+DEFAULT_REPLY = (
+    "I hear you, and it sounds like this week has been really heavy for you. "
+    "It's completely normal to feel overwhelmed when so many things pile up at once. "
+    "Could you tell me a bit more about what has been weighing on you the most? "
+    "Sometimes naming the main source of stress already makes it feel lighter. "
+    "I'm here with you, take all the time you need."
+)
+
+class FakeOpenAI:
+    def __init__(self, reply=DEFAULT_REPLY, first_token_latency=0.5, token_delay=0.02,
+                 tts_base_latency=0.4, tts_latency_per_char=0.004, transcription_latency=0.5,
+                 model_latencies=None, tail_ratio=0.0, tail_latency=0.0):
+        self.reply = reply
+        self.first_token_latency = first_token_latency
+        self.model_latencies = model_latencies or {}
+        self.tail_ratio = tail_ratio
+        self.tail_latency = tail_latency
+        self.chat_models = Counter()
+        self.token_delay = token_delay
+        self.tts_base_latency = tts_base_latency
+        self.tts_latency_per_char = tts_latency_per_char
+        self.transcription_latency = transcription_latency
+        self.requests = {'chat': 0, 'speech': 0, 'transcriptions': 0}
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_post('/v1/chat/completions', self.chat_completions)
+        self.app.router.add_post('/v1/audio/speech', self.speech)
+        self.app.router.add_post('/v1/audio/transcriptions', self.transcriptions)
+
+    async def start(self, host='127.0.0.1', port=0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _tokens(self):
+        words = self.reply.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    async def chat_completions(self, request):
+        self.requests['chat'] += 1
+        body = await request.json()
+        model = body.get('model', 'gpt-4o')
+        self.chat_models[model] += 1
+        latency = self.model_latencies.get(model, self.first_token_latency)
+        if random.random() < self.tail_ratio:
+            latency += self.tail_latency
+        tokens = self._tokens()
+        prompt_tokens = len(json.dumps(body.get('messages', []))) // 4
+        usage = {
+            'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens), 'total_tokens': prompt_tokens + len(tokens),
+            'prompt_tokens_details': {'cached_tokens': 0},
+        }
+
+        await asyncio.sleep(latency)
+        if not body.get('stream'):
+            await asyncio.sleep(self.token_delay * len(tokens))
+            return web.json_response({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.reply}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            chunk = {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        if body.get('stream_options', {}).get('include_usage'):
+            chunk = {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [], 'usage': usage,
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def speech(self, request):
+        self.requests['speech'] += 1
+        body = await request.json()
+        text = body.get('input', '')
+        await asyncio.sleep(self.tts_base_latency + self.tts_latency_per_char * len(text))
+        # Un faux flux Ogg/Opus, d'une taille proportionnelle au texte
+        return web.Response(body=b"OggS" + bytes(len(text) * 40), content_type='audio/ogg')
+
+    async def transcriptions(self, request):
+        self.requests['transcriptions'] += 1
+        await request.read()
+        await asyncio.sleep(self.transcription_latency)
+        return web.Response(text="I have had a really stressful week at work.", content_type='text/plain')
@@ -0,0 +1,86 @@
+"""Local stand-in for the Stripe API calls of the checkout, and signed webhooks.
+
+Point the stripe library at it with ``stripe.api_base = <base_url>``. Events
+built with ``invoice_paid_event`` are signed like Stripe does, so they pass
+``stripe.Webhook.construct_event`` with the same ``STRIPE_WEBHOOK_SECRET``.
+"""
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+class FakeStripe:
+    def __init__(self, webhook_secret, api_latency=0.3):
+        self.webhook_secret = webhook_secret
+        self.api_latency = api_latency
+        # user_id (metadata) -> id du client Stripe créé
+        self.customers = {}
+        self.requests = {'customers': 0, 'checkout_sessions': 0}
+        # Idempotency-Key -> réponse déjà renvoyée, comme l'API rejoue une requête répétée
+        self.idempotent = {}
+        self._ids = itertools.count(1)
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_post('/v1/customers', self.create_customer)
+        self.app.router.add_post('/v1/checkout/sessions', self.create_checkout_session)
+
+    async def start(self, host='127.0.0.1', port=0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def create_customer(self, request):
+        self.requests['customers'] += 1
+        params = await request.post()
+        await asyncio.sleep(self.api_latency)
+        key = request.headers.get('Idempotency-Key')
+        if key in self.idempotent:
+            return web.json_response(self.idempotent[key])
+        customer_id = f"cus_fake{next(self._ids)}"
+        self.customers[params.get('metadata[user_id]')] = customer_id
+        customer = {'id': customer_id, 'object': 'customer', 'created': int(time.time()), 'livemode': False}
+        if key:
+            self.idempotent[key] = customer
+        return web.json_response(customer)
+
+    async def create_checkout_session(self, request):
+        self.requests['checkout_sessions'] += 1
+        params = await request.post()
+        await asyncio.sleep(self.api_latency)
+        session_id = f"cs_fake{next(self._ids)}"
+        return web.json_response({
+            'id': session_id, 'object': 'checkout.session', 'livemode': False,
+            'customer': params.get('customer'), 'mode': 'subscription',
+            'url': f"https://checkout.stripe.test/c/pay/{session_id}",
+            'expires_at': int(time.time()) + 24 * 3600,
+        })
+
+    # Webhooks
+
+    def invoice_paid_event(self, customer_id, days=30) -> bytes:
+        now = int(time.time())
+        event = {
+            'id': f"evt_fake{next(self._ids)}", 'object': 'event', 'type': 'invoice.paid', 'created': now,
+            'data': {'object': {
+                'object': 'invoice', 'customer': customer_id,
+                'lines': {'object': 'list', 'data': [{'period': {'start': now, 'end': now + days * 24 * 3600}}]},
+            }},
+        }
+        return json.dumps(event).encode()
+
+    def sign(self, payload: bytes) -> str:
+        timestamp = int(time.time())
+        signed = f"{timestamp}.".encode() + payload
+        signature = hmac.new(self.webhook_secret.encode(), signed, hashlib.sha256).hexdigest()
+        return f"t={timestamp},v1={signature}"
@@ -0,0 +1,184 @@
+"""Local stand-in for the Telegram Bot API.
+
+Start the bot with ``TELEGRAM_API_BASE_URL=http://127.0.0.1:<port>``. Updates
+pushed with ``push_update`` are either POSTed to the registered webhook or
+served through getUpdates when the bot is polling. Everything the bot sends
+is recorded in ``sent`` with a timestamp.
+
+    python benchmarks/fake_telegram.py --port 8081 --updates 20
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Julie', 'username': 'julie_test_bot'}
+
+class FakeTelegram:
+    def __init__(self, send_latency=0.05):
+        self.send_latency = send_latency
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.allowed_updates = None
+        self.sent = []
+        self._updates = asyncio.Queue()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self._session = None
+        self.base_url = None
+
+        self.app = web.Application(client_max_size=50 * 1024 * 1024)
+        self.app.router.add_route('*', '/bot{token}/{method}', self.api)
+        self.app.router.add_get('/file/bot{token}/{path:.*}', self.download)
+
+    async def start(self, host='127.0.0.1', port=0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        port = self._runner.addresses[0][1]
+        self._session = aiohttp.ClientSession()
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # Construction des updates
+
+    def _message(self, user_id, **fields):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'},
+            **fields,
+        }
+
+    def text_update(self, user_id, text):
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+        return {'update_id': next(self._update_ids), 'message': self._message(user_id, text=text, entities=entities)}
+
+    def voice_update(self, user_id, duration=3):
+        voice = {'file_id': f'voice-{user_id}', 'file_unique_id': f'voice-{user_id}', 'duration': duration, 'mime_type': 'audio/ogg'}
+        return {'update_id': next(self._update_ids), 'message': self._message(user_id, voice=voice)}
+
+    async def push_update(self, update) -> None:
+        if self.webhook_url:
+            headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret} if self.webhook_secret else {}
+            async with self._session.post(self.webhook_url, json=update, headers=headers) as response:
+                response.raise_for_status()
+        else:
+            await self._updates.put(update)
+
+    def sent_to(self, chat_id):
+        return [entry for entry in self.sent if entry['chat_id'] == chat_id]
+
+    # API Bot
+
+    async def _params(self, request):
+        if request.method == 'GET':
+            return dict(request.query)
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for name, value in (await request.post()).items():
+            params[name] = value if isinstance(value, str) else value.file.read()
+        return params
+
+    def _ok(self, result):
+        return web.json_response({'ok': True, 'result': result})
+
+    async def api(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        handler = getattr(self, f'method_{method}', None)
+        if handler is None:
+            return web.json_response({'ok': False, 'error_code': 404, 'description': f'Not Found: {method}'}, status=404)
+        return await handler(params)
+
+    async def method_getMe(self, params):
+        return self._ok(BOT_USER)
+
+    async def method_setWebhook(self, params):
+        self.webhook_url = params.get('url') or None
+        self.webhook_secret = params.get('secret_token')
+        allowed = params.get('allowed_updates')
+        self.allowed_updates = json.loads(allowed) if isinstance(allowed, str) else allowed
+        return self._ok(True)
+
+    async def method_deleteWebhook(self, params):
+        self.webhook_url = None
+        return self._ok(True)
+
+    async def method_getUpdates(self, params):
+        timeout = float(params.get('timeout') or 0)
+        allowed = params.get('allowed_updates')
+        self.allowed_updates = json.loads(allowed) if isinstance(allowed, str) else allowed
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self._updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            pass
+        while not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+        return self._ok(updates)
+
+    async def _record(self, method, params, **message_fields):
+        await asyncio.sleep(self.send_latency)
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, **message_fields)
+        message['from'] = BOT_USER
+        self.sent.append({'method': method, 'chat_id': chat_id, 'time': time.perf_counter(), 'message': message})
+        return self._ok(message)
+
+    async def method_sendMessage(self, params):
+        return await self._record('sendMessage', params, text=params.get('text', ''))
+
+    async def method_editMessageText(self, params):
+        return await self._record('editMessageText', params, text=params.get('text', ''))
+
+    async def method_sendVoice(self, params):
+        voice = params.get('voice')
+        file_id = voice if isinstance(voice, str) else f'uploaded-{next(self._message_ids)}'
+        return await self._record('sendVoice', params, voice={'file_id': file_id, 'file_unique_id': file_id, 'duration': 1})
+
+    async def method_sendChatAction(self, params):
+        return self._ok(True)
+
+    async def method_getFile(self, params):
+        file_id = params['file_id']
+        return self._ok({'file_id': file_id, 'file_unique_id': file_id, 'file_size': 4096, 'file_path': f'voice/{file_id}.oga'})
+
+    async def download(self, request):
+        return web.Response(body=b"OggS" + bytes(4092), content_type='audio/ogg')
+
+async def run(args):
+    fake = FakeTelegram()
+    base_url = await fake.start(port=args.port)
+    print(f"Fake Telegram Bot API on {base_url}, waiting for setWebhook or getUpdates...")
+    while args.webhook and fake.webhook_url is None:
+        await asyncio.sleep(0.1)
+    for i in range(args.updates):
+        await fake.push_update(fake.text_update(1000 + i % args.users, f"Hello, this is message {i}"))
+    try:
+        while True:
+            await asyncio.sleep(1)
+            print(f"{len(fake.sent)} messages sent by the bot")
+    finally:
+        await fake.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--updates', type=int, default=0)
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--webhook', action='store_true', help="wait for the bot to register its webhook first")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,180 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import tiktoken
+from sqlalchemy import func, select
+
+from database import AsyncSession, Message, ConversationSummary
+from history_cache import history_cache, HISTORY_CACHE_MAX_USERS
+from message_buffer import message_buffer
+from openai_client import summarize
+
+logger = logging.getLogger(__name__)
+
+# Budget de tokens de l'historique envoyé avec chaque message
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1500))
+# Messages intégrés au résumé par appel OpenAI
+SUMMARY_BATCH_SIZE = int(os.getenv('SUMMARY_BATCH_SIZE', 100))
+# Appels OpenAI au plus par mise à jour du résumé ; le premier résumé d'un
+# utilisateur ne reprend que ses SUMMARY_MAX_BATCHES * SUMMARY_BATCH_SIZE derniers messages
+SUMMARY_MAX_BATCHES = int(os.getenv('SUMMARY_MAX_BATCHES', 3))
+# Quand la fenêtre dépasse le budget, elle est réduite à cette fraction du budget
+CONTEXT_WINDOW_REFILL = float(os.getenv('CONTEXT_WINDOW_REFILL', 0.5))
+# Tokens ajoutés par OpenAI pour chaque message (rôle, séparateurs)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Encodage des modèles gpt-4o, chargé au démarrage par preload_encoding
+_encoding = None
+
+def load_encoding() -> None:
+    """Load the tokenizer, downloaded on first use unless TIKTOKEN_CACHE_DIR already holds it."""
+    global _encoding
+    try:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logger.exception("Could not load the tiktoken encoding, token counts are estimated")
+
+def preload_encoding() -> None:
+    # Dans un thread : le téléchargement ne bloque pas la boucle d'événements
+    threading.Thread(target=load_encoding, name='tiktoken', daemon=True).start()
+
+@functools.lru_cache(maxsize=8192)
+def _encoded_length(text: str) -> int:
+    return len(_encoding.encode(text, disallowed_special=()))
+
+def count_tokens(text: str) -> int:
+    if _encoding is None:
+        # Encodage pas encore chargé, ou indisponible : estimation
+        return len(text) // 4
+    return _encoded_length(text)
+
+def format_turn(is_sent_by_user: bool, text: str) -> str:
+    return f"user: {text}\n" if is_sent_by_user else f"you: {text}\n"
+
+def turn_message(is_sent_by_user: bool, text: str) -> dict:
+    return {"role": "user" if is_sent_by_user else "assistant", "content": text}
+
+# user_id -> premier tour de la fenêtre envoyée au tour précédent
+_window_starts = OrderedDict()
+
+def _window(user_id, turns, budget, unsummarized: int):
+    costs = [count_tokens(text) + MESSAGE_OVERHEAD_TOKENS for _, text in turns]
+
+    # Tant que la fenêtre tient dans le budget, elle commence au même tour :
+    # le début du prompt reste identique et profite du cache d'OpenAI.
+    anchor = _window_starts.get(user_id)
+    start = next((i for i, turn in enumerate(turns) if turn is anchor), None)
+    if start is None or sum(costs[start:]) > budget:
+        # Sinon on repart d'une fenêtre plus courte pour pouvoir grandir
+        # pendant plusieurs tours avant de bouger à nouveau.
+        start = len(turns)
+        used = 0
+        while start > 0 and used + costs[start - 1] <= budget * CONTEXT_WINDOW_REFILL:
+            start -= 1
+            used += costs[start]
+
+    # Les tours qui ne sont pas encore dans le résumé restent dans la fenêtre,
+    # quitte à dépasser le budget, jusqu'à ce que le résumé les rattrape.
+    first_unsummarized = len(turns) - unsummarized
+    if start > first_unsummarized:
+        schedule_summary(user_id, keep=len(turns) - start)
+        start = max(0, first_unsummarized)
+
+    if start < len(turns):
+        _window_starts[user_id] = turns[start]
+        _window_starts.move_to_end(user_id)
+        while len(_window_starts) > HISTORY_CACHE_MAX_USERS:
+            _window_starts.popitem(last=False)
+    return turns[start:]
+
+def build_history(user_id, summary, turns, unsummarized: int, budget: int = CONTEXT_TOKEN_BUDGET) -> list:
+    """Chat messages for the summary and the recent turns, within ``budget`` tokens.
+
+    ``unsummarized`` is how many of the latest messages the summary does not
+    cover: those are always sent, so no turn is left out of the prompt.
+    """
+    messages = []
+    if summary:
+        summary_message = {"role": "system", "content": f"Summary of our earlier conversation: {summary}"}
+        messages.append(summary_message)
+        budget -= count_tokens(summary_message["content"]) + MESSAGE_OVERHEAD_TOKENS
+    window = _window(user_id, turns, budget, unsummarized)
+    messages.extend(turn_message(is_sent_by_user, text) for is_sent_by_user, text in window)
+    return messages
+
+_refreshing = set()
+_tasks = set()
+
+def schedule_summary(user_id, keep: int) -> None:
+    """Summarize in the background every message but the ``keep`` latest ones."""
+    if user_id in _refreshing:
+        return
+    _refreshing.add(user_id)
+    task = asyncio.create_task(refresh_summary(user_id, keep))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def refresh_summary(user_id, keep: int) -> None:
+    """Fold every message before the ``keep`` latest ones into the stored summary.
+
+    At most SUMMARY_MAX_BATCHES calls are made; the rest is folded at a later
+    refresh. Messages arriving meanwhile only make the summary overlap the window.
+    """
+    try:
+        # Les derniers messages doivent être en base pour délimiter la fenêtre
+        await message_buffer.flush()
+        async with AsyncSession() as session:
+            row = await session.get(ConversationSummary, user_id)
+            window_start = None
+            if keep:
+                result = await session.execute(
+                    select(Message.id).filter_by(user_id=user_id).order_by(Message.id.desc()).limit(keep)
+                )
+                recent_ids = result.scalars().all()
+                if len(recent_ids) < keep:
+                    return
+                # Premier message de la fenêtre envoyée : tout ce qui précède va dans le résumé
+                window_start = min(recent_ids)
+            before_window = [Message.user_id == user_id]
+            if window_start is not None:
+                before_window.append(Message.id < window_start)
+
+            floor, skipped = None, 0
+            if row is None:
+                # Premier résumé, souvent d'un long historique : seuls les derniers
+                # messages y entrent, sans une longue série d'appels OpenAI.
+                floor = await session.scalar(
+                    select(Message.id).where(*before_window).order_by(Message.id.desc())
+                    .offset(SUMMARY_MAX_BATCHES * SUMMARY_BATCH_SIZE).limit(1)
+                )
+                if floor is not None:
+                    skipped = await session.scalar(
+                        select(func.count(Message.id)).where(Message.user_id == user_id, Message.id <= floor)
+                    )
+
+            for _ in range(SUMMARY_MAX_BATCHES):
+                last_message_id = row.last_message_id if row else floor or 0
+                query = select(Message).where(*before_window, Message.id > last_message_id)
+                result = await session.execute(query.order_by(Message.id).limit(SUMMARY_BATCH_SIZE))
+                older = result.scalars().all()
+                if not older:
+                    break
+                transcript = "".join(format_turn(msg.is_sent_by_user, msg.message) for msg in older)
+                summary = await summarize(row.summary if row else "", transcript)
+                if row:
+                    row.summary = summary
+                    row.last_message_id = older[-1].id
+                else:
+                    row = ConversationSummary(user_id=user_id, summary=summary, last_message_id=older[-1].id)
+                    session.add(row)
+                await session.commit()
+                history_cache.set_summary(user_id, summary, folded=len(older) + skipped)
+                skipped = 0
+    except Exception:
+        logger.exception("Could not refresh the summary of user %s", user_id)
+    finally:
+        _refreshing.discard(user_id)
@@ -1,6 +1,8 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, func, Text
+from sqlalchemy import create_engine, Column, BigInteger, Integer, String, Boolean, ForeignKey, Date, DateTime, func, Text, Index, LargeBinary
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.dialects.mysql import MEDIUMTEXT, MEDIUMBLOB
 from dotenv import load_dotenv
 
 load_dotenv()  # Charge les variables d'environnement à partir du fichier .env
@@ -13,19 +15,86 @@ DATABASE_HOST = os.getenv('DATABASE_HOST')
 DATABASE_PORT = os.getenv('DATABASE_PORT')
 DATABASE_NAME = os.getenv('DATABASE_NAME')
 
-DATABASE_URL = f"mysql+pymysql://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+# Les URL complètes peuvent être fournies directement (benchmarks sur SQLite, MySQL local)
+DATABASE_URL = os.getenv('DATABASE_URL', f"mysql+pymysql://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}")
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL', f"mysql+aiomysql://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}")
 
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
-session = Session()
+# Taille du pool de connexions par process
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 10))
+DATABASE_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW', 10))
+# Recycler les connexions avant que MySQL ne les ferme (wait_timeout)
+DATABASE_POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', 280))
+
+# Les moteurs sont créés à la première session et non à l'import : rien ne se
+# connecte au chargement, et avec `gunicorn --preload` chaque worker a son pool.
+_engines = {}
+
+def get_engine():
+    """Synchronous engine: Flask app, background threads, scripts."""
+    if 'sync' not in _engines:
+        _engines['sync'] = create_engine(DATABASE_URL, pool_pre_ping=True, pool_recycle=DATABASE_POOL_RECYCLE)
+    return _engines['sync']
+
+def get_async_engine():
+    """Asynchronous engine: bot handlers, so the event loop is never blocked."""
+    if 'async' not in _engines:
+        _engines['async'] = create_async_engine(
+            ASYNC_DATABASE_URL,
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=DATABASE_POOL_RECYCLE,
+        )
+    return _engines['async']
+
+async def dispose_engines() -> None:
+    if 'async' in _engines:
+        await _engines.pop('async').dispose()
+    if 'sync' in _engines:
+        _engines.pop('sync').dispose()
+
+class LazySessionmaker(sessionmaker):
+    def __init__(self, get_bind, **kw):
+        super().__init__(**kw)
+        self._get_bind = get_bind
+
+    def __call__(self, **local_kw):
+        local_kw.setdefault('bind', self._get_bind())
+        return super().__call__(**local_kw)
+
+class LazyAsyncSessionmaker(async_sessionmaker):
+    def __init__(self, get_bind, **kw):
+        super().__init__(**kw)
+        self._get_bind = get_bind
+
+    def __call__(self, **local_kw):
+        local_kw.setdefault('bind', self._get_bind())
+        return super().__call__(**local_kw)
+
+# Les deux seules fabriques de sessions de l'application
+Session = LazySessionmaker(get_engine)
+AsyncSession = LazyAsyncSessionmaker(get_async_engine, expire_on_commit=False)
 
 class User(Base):
     __tablename__ = 'users'
     user_id = Column(Integer, primary_key=True, unique=True, nullable=False)
     stripe_customer_id = Column(String(255), nullable=True)  # Spécifier la longueur maximale
     username = Column(String(255))  # Spécifier la longueur maximale
+    message_count = Column(Integer, nullable=False, default=0, server_default='0')  # Messages envoyés par l'utilisateur
+    # Dernier lot de messages écrits en différé compté dans message_count (voir message_buffer)
+    message_batch = Column(BigInteger, nullable=False, default=0, server_default='0')
+    # Fin de la dernière période payée (UTC), mise à jour par le webhook invoice.paid
+    subscription_end_date = Column(DateTime, nullable=True)
+    # Dernière session de paiement Stripe, réutilisée tant qu'elle n'a pas expiré
+    checkout_session_url = Column(Text, nullable=True)
+    checkout_session_expires_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=func.now())
 
+    __table_args__ = (
+        # Webhooks Stripe : recherche de l'utilisateur par client Stripe
+        Index('ix_users_stripe_customer_id', 'stripe_customer_id'),
+    )
+
 class Message(Base):
     __tablename__ = 'messages'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -33,6 +102,17 @@ class Message(Base):
     message = Column(Text, nullable=False)  # Utiliser le type Text pour des messages longs
     is_sent_by_user = Column(Boolean, nullable=False)
     created_at = Column(DateTime, default=func.now())
+    # Consommation OpenAI des réponses générées (tokens en cache inclus)
+    prompt_tokens = Column(Integer, nullable=True)
+    cached_prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        # Historique récent d'un utilisateur
+        Index('ix_messages_user_id_created_at', 'user_id', 'created_at'),
+        # Messages envoyés par un utilisateur
+        Index('ix_messages_user_id_is_sent_by_user', 'user_id', 'is_sent_by_user'),
+    )
 
 class Subscription(Base):
     __tablename__ = 'subscriptions'
@@ -42,6 +122,11 @@ class Subscription(Base):
     end_date= Column(DateTime)
     created_at = Column(DateTime, default=func.now())  # Nouvelle colonne ajoutée
 
+    __table_args__ = (
+        # Abonnement le plus récent d'un utilisateur
+        Index('ix_subscriptions_user_id_created_at', 'user_id', 'created_at'),
+    )
+
 
 class Feedback(Base):
     __tablename__ = 'feedback'
@@ -50,6 +135,64 @@ class Feedback(Base):
     feedback_text = Column(Text, nullable=False)
     created_at = Column(DateTime, default=func.now())
 
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summaries'
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    summary = Column(Text, nullable=False)
+    # Dernier message intégré au résumé
+    last_message_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+class ProcessedEvent(Base):
+    __tablename__ = 'processed_events'
+    # Identifiant de l'événement Stripe : une relivraison est ignorée
+    event_id = Column(String(255), primary_key=True)
+    event_type = Column(String(255), nullable=False)
+    payload = Column(Text().with_variant(MEDIUMTEXT(), 'mysql'), nullable=False)
+    received_at = Column(DateTime, default=func.now())
+    processed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Événements restant à appliquer au redémarrage
+        Index('ix_processed_events_processed_at', 'processed_at'),
+    )
+
+class UserState(Base):
+    __tablename__ = 'user_states'
+    # État de conversation d'un utilisateur (ex. : retour d'expérience attendu)
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    key = Column(String(64), primary_key=True)
+    value = Column(Text, nullable=False)  # JSON
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+class MessageArchive(Base):
+    __tablename__ = 'message_archives'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    month = Column(String(7), nullable=False)  # AAAA-MM des messages archivés
+    first_message_id = Column(Integer, nullable=False)
+    last_message_id = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    # Messages en JSONL compressé (gzip), jamais réécrits
+    data = Column(LargeBinary().with_variant(MEDIUMBLOB(), 'mysql'), nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        # Historique complet d'un utilisateur, dans l'ordre
+        Index('ix_message_archives_user_id_first_message_id', 'user_id', 'first_message_id'),
+    )
 
+class DailyUserStats(Base):
+    __tablename__ = 'daily_user_stats'
+    # Compteurs d'un utilisateur sur une journée (UTC), lus par les rapports à la place des tables vivantes
+    day = Column(Date, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    user_messages = Column(Integer, nullable=False, default=0, server_default='0')
+    voice_messages = Column(Integer, nullable=False, default=0, server_default='0')  # Parmi user_messages
+    replies = Column(Integer, nullable=False, default=0, server_default='0')
+    paywall_hits = Column(Integer, nullable=False, default=0, server_default='0')
+    feedback = Column(Integer, nullable=False, default=0, server_default='0')
+    payments = Column(Integer, nullable=False, default=0, server_default='0')
+    conversions = Column(Integer, nullable=False, default=0, server_default='0')  # Premier paiement de l'utilisateur
 
-Base.metadata.create_all(engine)
+# Le schéma est géré par les migrations Alembic : `alembic upgrade head`
@@ -1,149 +1,208 @@
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from pathlib import Path
 from dotenv import load_dotenv
-from datetime import datetime
-import uuid
 import os
-from sqlalchemy.orm import sessionmaker
-from contextlib import contextmanager
-
-from database import engine, User, Message, Subscription, Feedback
-from openai_client import generate_response, transcribe_audio, create_speech
+from contextlib import asynccontextmanager
+from sqlalchemy import func, select
+from sqlalchemy.orm.attributes import set_committed_value
+
+from database import AsyncSession, User, Message, Feedback, ConversationSummary
+from openai_client import generate_response, stream_response, transcribe_audio
+from streaming import send_streamed_reply
+from voice_pipeline import speak, speak_pipelined
+import quota
+from quota import PAYWALL_TEXT, FEEDBACK_THANKS_TEXT
+from history_cache import history_cache, HISTORY_TURNS
+from context_builder import build_history
+from metrics import span
+from message_buffer import message_buffer, message_row, MESSAGE_WRITE_BEHIND
+from state_store import state_store
+from stripe_client import schedule_customer
+from rollups import rollup_buffer
 
 load_dotenv()
 
 DOMAIN = os.getenv('DOMAIN')
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'true').lower() == 'true'
+VOICE_PIPELINE = os.getenv('VOICE_PIPELINE', 'true').lower() == 'true'
 
 logger = logging.getLogger(__name__)
 
-Session = sessionmaker(bind=engine)
-
-@contextmanager
-def session_scope():
-    session = Session()
-    try:
-        yield session
-        session.commit()
-    except Exception:
-        session.rollback()
-        raise
-    finally:
-        session.close()
+async def commit(session) -> None:
+    with span('db.commit'):
+        await session.commit()
+    for callback in session.info.pop('on_commit', []):
+        callback()
+
+@asynccontextmanager
+async def session_scope():
+    async with AsyncSession() as session:
+        try:
+            yield session
+            await commit(session)
+        except Exception:
+            await session.rollback()
+            raise
+
+def count_event(session, user_id, counter: str) -> None:
+    # Compté une fois le tour validé en base ; les compteurs partent par lots
+    session.info.setdefault('on_commit', []).append(lambda: rollup_buffer.count(user_id, counter))
+
+async def get_or_create_user(session, user):
+    db_user = await session.get(User, user.id)
+    if not db_user:
+        db_user = User(user_id=user.id, username=user.username, message_count=0, message_batch=0)
+        session.add(db_user)
+        # La ligne doit exister avant que les messages soient écrits en différé
+        await session.flush()
+    if MESSAGE_WRITE_BEHIND:
+        # Complété des messages en attente d'écriture : le quota voit le compte réel
+        pending = message_buffer.pending_count(db_user.user_id, db_user.message_batch)
+        if pending:
+            set_committed_value(db_user, 'message_count', db_user.message_count + pending)
+    return db_user
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    with session_scope() as session:
-        user = update.message.from_user
-        db_user = session.query(User).filter_by(user_id=user.id).first()
-        if not db_user:
-            db_user = User(user_id=user.id, username=user.username)
-            session.add(db_user)
+    async with session_scope() as session:
+        db_user = await get_or_create_user(session, update.message.from_user)
+        if not db_user.stripe_customer_id:
+            # Client Stripe créé d'avance : le clic sur le paywall n'a plus à l'attendre
+            user_id = db_user.user_id
+            session.info.setdefault('on_commit', []).append(lambda: schedule_customer(user_id))
     await update.message.reply_text("Hello! I'm Julie, your virtual confidant and life coach. I'm here to listen and offer guidance whenever you need it.\nPlease note that I'm not a substitute for a healthcare professional. If you're facing serious issues, it's important to reach out to a professional or a specialized service.\nFeel free to send me messages 💬 or voice notes 🔊 anytime.\nI look forward to our conversations! 🌟")
 
 
 def check_user_quota(db_user):
-    with session_scope() as session:
-        user_message_count = session.query(Message).filter_by(user_id=db_user.user_id, is_sent_by_user=True).count()
-        if user_message_count >= 10:
-            payment = session.query(Subscription).filter_by(user_id=db_user.user_id).order_by(Subscription.created_at.desc()).first()
-            if not payment or not payment.end_date or payment.end_date < datetime.utcnow():
-                return False
-    return True
-
-def create_message_history(db_user):
-    with session_scope() as session:
-        recent_messages = session.query(Message).filter_by(user_id=db_user.user_id).order_by(Message.created_at.desc()).limit(6).all()
-        recent_messages = reversed(recent_messages)
-        conversation_history = ""
-        for msg in recent_messages:
-            if msg.is_sent_by_user:
-                conversation_history += f"user: {msg.message}\n"
-            else:
-                conversation_history += f"you: {msg.message}\n"
-    return conversation_history
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    with session_scope() as session:
-        user_message = update.message.text
-        user = update.message.from_user
-        db_user = session.query(User).filter_by(user_id=user.id).first()
-
-        if context.user_data.get('collecting_feedback'):
-            feedback = Feedback(user_id=db_user.user_id, feedback_text=user_message)
-            session.add(feedback)
-            await update.message.reply_text(
-                "Thank you very much for your valuable feedback! We will take it into account. \n \nYou can now resume your normal conversation."
+    if db_user.message_count < quota.FREE_MESSAGE_LIMIT:
+        return True
+    # Date de fin tenue à jour par le webhook Stripe sur la ligne déjà lue pour ce tour
+    return quota.is_subscription_active(db_user.subscription_end_date)
+
+def add_message(session, db_user, text, is_sent_by_user, usage=None):
+    user_id = db_user.user_id
+    callbacks = session.info.setdefault('on_commit', [])
+    if MESSAGE_WRITE_BEHIND:
+        # Mis en file au commit du tour ; le lot ajoute aussi le compte en base
+        row = message_row(user_id, text, is_sent_by_user, usage)
+        callbacks.append(lambda: message_buffer.add(row))
+        if is_sent_by_user:
+            set_committed_value(db_user, 'message_count', (db_user.message_count or 0) + 1)
+    else:
+        session.add(Message(user_id=user_id, message=text, is_sent_by_user=is_sent_by_user, **(usage or {})))
+        if is_sent_by_user:
+            db_user.message_count = (db_user.message_count or 0) + 1
+    callbacks.append(lambda: history_cache.append(user_id, is_sent_by_user, text))
+    count_event(session, user_id, 'user_messages' if is_sent_by_user else 'paywall_hits' if text == PAYWALL_TEXT else 'replies')
+
+async def create_message_history(session, db_user):
+    turns = history_cache.get(db_user.user_id)
+    if turns is None:
+        result = await session.execute(
+            select(Message).filter_by(user_id=db_user.user_id).order_by(Message.created_at.desc(), Message.id.desc()).limit(HISTORY_TURNS)
+        )
+        turns = [(msg.is_sent_by_user, msg.message) for msg in reversed(result.scalars().all())]
+        summary = await session.get(ConversationSummary, db_user.user_id)
+        # Messages que le résumé ne couvre pas encore : ils restent tous dans la fenêtre
+        unsummarized = await session.scalar(
+            select(func.count(Message.id)).where(
+                Message.user_id == db_user.user_id, Message.id > (summary.last_message_id if summary else 0)
             )
-            context.user_data['collecting_feedback'] = False
-            return
+        )
+        pending = message_buffer.pending_turns(db_user.user_id)
+        turns = (turns + pending)[-HISTORY_TURNS:]
+        history_cache.load(db_user.user_id, turns, summary.summary if summary else None, unsummarized + len(pending))
+    return build_history(
+        db_user.user_id, history_cache.get_summary(db_user.user_id), turns, history_cache.get_unsummarized(db_user.user_id)
+    )
+
+async def prepare_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, session, user_message: str):
+    """Record the user's message and return ``(db_user, conversation_history)``.
+
+    Returns ``None`` when the message was handled here (feedback or paywall).
+    Everything runs in the caller's session, and the transaction is committed
+    before returning so no connection is held during the OpenAI call.
+    """
+    with span('db.user'):
+        db_user = await get_or_create_user(session, update.message.from_user)
+
+    if await state_store.get(db_user.user_id, 'collecting_feedback', session=session):
+        session.add(Feedback(user_id=db_user.user_id, feedback_text=user_message))
+        count_event(session, db_user.user_id, 'feedback')
+        await state_store.delete(db_user.user_id, 'collecting_feedback', session=session)
+        await commit(session)
+        await update.message.reply_text(FEEDBACK_THANKS_TEXT)
+        return None
+
+    with span('history'):
+        conversation_history = await create_message_history(session, db_user)
+    add_message(session, db_user, user_message, True)
+    if update.message.voice:
+        count_event(session, db_user.user_id, 'voice_messages')
+
+    with span('quota'):
+        allowed = check_user_quota(db_user)
+    if not allowed:
+        payment_url = f"https://{DOMAIN}/redirect_to_stripe?user_id={db_user.user_id}"
+        keyboard = [[InlineKeyboardButton("👩 Continue chatting", url=payment_url)]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        add_message(session, db_user, PAYWALL_TEXT, False)
+        await commit(session)
+        await update.message.reply_text(
+            text=PAYWALL_TEXT,
+            reply_markup=reply_markup
+        )
+        return None
+
+    await commit(session)
+    return db_user, conversation_history
 
-        user_msg = Message(user_id=db_user.user_id, message=user_message, is_sent_by_user=True)
-        session.add(user_msg)
-
-        if not check_user_quota(db_user):
-            payment_url = f"https://{DOMAIN}/redirect_to_stripe?user_id={db_user.user_id}"
-            text = f"You have reached the message limit 🙁 \n \nTo continue our conversation, a subscription of $9.99/month (no commitment) is required.\n \nI am available 24/7, always here to help you through tough times and to become the best version of yourself \n\nClick on 'Continue chatting' to no longer face your problems alone."
-            keyboard = [[InlineKeyboardButton("👩 Continue chatting", url=payment_url)]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            bot_msg = Message(user_id=db_user.user_id, message=text, is_sent_by_user=False)
-            session.add(bot_msg)
-            await update.message.reply_text(
-                text=text,
-                reply_markup=reply_markup
-            )
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_message = update.message.text
+    async with session_scope() as session:
+        prepared = await prepare_reply(update, context, session, user_message)
+        if prepared is None:
             return
+        db_user, conversation_history = prepared
 
-        conversation_history = create_message_history(db_user)
-        ai_response = generate_response(conversation_history, user_message)
-        bot_msg = Message(user_id=db_user.user_id, message=ai_response, is_sent_by_user=False)
-        session.add(bot_msg)
+        usage = {}
+        if STREAM_REPLIES:
+            with span('reply.stream'):
+                ai_response = await send_streamed_reply(update.message, stream_response(conversation_history, user_message, usage))
+        else:
+            ai_response = await generate_response(conversation_history, user_message, usage)
+        add_message(session, db_user, ai_response, False, usage)
 
-    await update.message.reply_text(ai_response)
+    if not STREAM_REPLIES:
+        with span('telegram.reply'):
+            await update.message.reply_text(ai_response)
 
 async def audio_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    with session_scope() as session:
+    with span('telegram.download'):
         voice_file = await update.message.voice.get_file()
-        voice_file_path = f"user_voice_{uuid.uuid4()}.ogg"
-        await voice_file.download_to_drive(voice_file_path)
-
-        user_message = transcribe_audio(voice_file_path)
-        user = update.message.from_user
-        db_user = session.query(User).filter_by(user_id=user.id).first()
-
-        if context.user_data.get('collecting_feedback'):
-            feedback = Feedback(user_id=db_user.user_id, feedback_text=user_message)
-            session.add(feedback)
-            await update.message.reply_text(
-                "Thank you very much for your valuable feedback! We will take it into account. \n \nYou can now resume your normal conversation."
-            )
-            context.user_data['collecting_feedback'] = False
-            return
+        voice_data = await voice_file.download_as_bytearray()
+    user_message = await transcribe_audio(bytes(voice_data))
 
-        user_msg = Message(user_id=db_user.user_id, message=user_message, is_sent_by_user=True)
-        session.add(user_msg)
-
-        if not check_user_quota(db_user):
-            payment_url = f"https://{DOMAIN}/redirect_to_stripe?user_id={db_user.user_id}"
-            text = "You have reached the message limit 🙁 \n \nTo continue our conversation, a subscription of $9.99/month (no commitment) is required.\n \nI am available 24/7, always here to help you through tough times and to become the best version of yourself \n\nClick on 'Continue chatting' to no longer face your problems alone."
-            keyboard = [[InlineKeyboardButton("👩 Continue chatting", url=payment_url)]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            bot_msg = Message(user_id=db_user.user_id, message=text, is_sent_by_user=False)
-            session.add(bot_msg)
-            await update.message.reply_text(
-                text=text,
-                reply_markup=reply_markup
-            )
+    async with session_scope() as session:
+        prepared = await prepare_reply(update, context, session, user_message)
+        if prepared is None:
             return
+        db_user, conversation_history = prepared
+
+        usage = {}
+        if VOICE_PIPELINE:
+            with span('reply.voice'):
+                ai_response = await speak_pipelined(
+                    stream_response(conversation_history, user_message, usage),
+                    lambda speech: update.message.reply_voice(voice=speech)
+                )
+        else:
+            ai_response = await generate_response(conversation_history, user_message, usage)
+        add_message(session, db_user, ai_response, False, usage)
 
-        conversation_history = create_message_history(db_user)
-        ai_response = generate_response(conversation_history, user_message)
-        bot_msg = Message(user_id=db_user.user_id, message=ai_response, is_sent_by_user=False)
-        session.add(bot_msg)
-
-    speech_file_path = create_speech(ai_response)
-    with open(speech_file_path, 'rb') as audio_file:
-        await update.message.reply_voice(voice=audio_file)
+    if not VOICE_PIPELINE:
+        with span('reply.voice'):
+            await speak(ai_response, lambda speech: update.message.reply_voice(voice=speech))
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.message.from_user
@@ -151,32 +210,31 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Bye! I hope we can talk again some day.")
 
 async def manage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    with session_scope() as session:
+    async with session_scope() as session:
         user = update.message.from_user
-        db_user = session.query(User).filter_by(user_id=user.id).first()
-
-        if db_user:
-            manage_url = f"https://{DOMAIN}/create-customer-portal-session?user_id={db_user.user_id}"
-            keyboard = [[InlineKeyboardButton("Manage subscription", url=manage_url)]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(
-                "Click here to manage your subscription.",
-                reply_markup=reply_markup
-            )
-        else:
-            await update.message.reply_text("User not found, please retry again.")
+        db_user = await session.get(User, user.id)
+
+    if db_user:
+        manage_url = f"https://{DOMAIN}/create-customer-portal-session?user_id={db_user.user_id}"
+        keyboard = [[InlineKeyboardButton("Manage subscription", url=manage_url)]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(
+            "Click here to manage your subscription.",
+            reply_markup=reply_markup
+        )
+    else:
+        await update.message.reply_text("User not found, please retry again.")
 
 async def collect_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    with session_scope() as session:
+    async with session_scope() as session:
         user = update.message.from_user
-        db_user = session.query(User).filter_by(user_id=user.id).first()
-
+        db_user = await session.get(User, user.id)
         if db_user:
-            await update.message.reply_text(
-                "We would love to hear your feedback! \n \nPlease share your comments by replying to this message."
-            )
-            context.user_data['collecting_feedback'] = True
-        else:
-            await update.message.reply_text("User not found, please retry again.")
-
-
+            await state_store.set(db_user.user_id, 'collecting_feedback', True, session=session)
+
+    if db_user:
+        await update.message.reply_text(
+            "We would love to hear your feedback! \n \nPlease share your comments by replying to this message."
+        )
+    else:
+        await update.message.reply_text("User not found, please retry again.")
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Latences récentes gardées par modèle
+LATENCY_WINDOW = int(os.getenv('LATENCY_WINDOW', 200))
+# En dessous de ce nombre de mesures, le délai par défaut s'applique
+LATENCY_MIN_SAMPLES = int(os.getenv('LATENCY_MIN_SAMPLES', 20))
+# La requête de secours part quand la première dépasse ce percentile de latence
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 1.0))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 3.0))
+
+class LatencyTracker:
+    """Rolling window of the latest latencies of each model."""
+
+    def __init__(self, window: int):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, key, seconds: float) -> None:
+        self._samples[key].append(seconds)
+
+    @contextmanager
+    def timing(self, key):
+        """Record how long the block takes, also when it is cancelled."""
+        start = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # Requête lente annulée (secours plus rapide, délai dépassé) : la durée
+            # écoulée minore sa latence. Sans elle le percentile ne verrait que les
+            # réponses rapides et le délai avant secours baisserait sans fin.
+            self.record(key, time.perf_counter() - start)
+            raise
+        self.record(key, time.perf_counter() - start)
+
+    def percentile(self, key, q: float):
+        samples = self._samples.get(key)
+        if not samples or len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def hedge_delay(self, key) -> float:
+        """Seconds to wait for ``key`` before sending the hedged request."""
+        threshold = self.percentile(key, HEDGE_PERCENTILE)
+        if threshold is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, threshold)
+
+latencies = LatencyTracker(LATENCY_WINDOW)
+
+async def hedged(request, models: list, delay: float, discard=None, admit=None):
+    """Return ``(model, result)`` of the first ``request(model)`` to succeed.
+
+    ``models[0]`` is tried first; the next model is tried after ``delay``
+    seconds without an answer, or as soon as every request sent so far has
+    failed. Each extra request first awaits ``admit()``, which charges it to
+    the rate limits. The requests still running are
+    cancelled, and the results that arrived too late are passed to
+    ``discard`` (a coroutine function).
+    """
+    pending = {}
+    errors = []
+
+    async def admitted(model):
+        # L'attente du budget ne retient pas la réponse des requêtes déjà parties
+        await admit()
+        return await request(model)
+
+    def launch():
+        # Rang d'envoi et non nom du modèle : le même modèle peut figurer deux fois
+        started = len(pending) + len(errors)
+        model = models[started]
+        extra = admit is not None and started > 0
+        pending[asyncio.create_task(admitted(model) if extra else request(model))] = model
+
+    launch()
+    try:
+        while pending:
+            more = len(pending) + len(errors) < len(models)
+            done, _ = await asyncio.wait(pending, timeout=delay if more else None, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                model = pending.pop(task)
+                if task.exception() is None:
+                    return model, task.result()
+                errors.append(task.exception())
+            if more and (not done or not pending):
+                launch()
+        raise errors[-1]
+    finally:
+        for task in pending:
+            if not task.done():
+                task.cancel()
+            elif discard is not None and not task.cancelled() and task.exception() is None:
+                await discard(task.result())
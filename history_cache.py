@@ -0,0 +1,107 @@
+import os
+import sys
+from collections import OrderedDict, deque
+
+# Nombre de messages récents gardés pour construire le contexte ; ceux qui
+# entrent dans le budget de tokens sont envoyés à OpenAI (voir context_builder)
+HISTORY_TURNS = int(os.getenv('HISTORY_TURNS', 20))
+# Limites mémoire du cache : nombre d'utilisateurs et taille totale des textes
+HISTORY_CACHE_MAX_USERS = int(os.getenv('HISTORY_CACHE_MAX_USERS', 10000))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv('HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+class HistoryCache:
+    """LRU cache of each user's most recent turns as ``(is_sent_by_user, text)``.
+
+    Also holds the user's rolling conversation summary, if any, and how many
+    of the latest messages it does not cover yet.
+    """
+
+    def __init__(self, max_turns: int, max_users: int, max_bytes: int):
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._summaries = {}
+        # user_id -> nombre de messages récents absents du résumé
+        self._unsummarized = {}
+        self._sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        turns = self._entries.get(user_id)
+        if turns is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        return list(turns)
+
+    def get_summary(self, user_id):
+        return self._summaries.get(user_id)
+
+    def get_unsummarized(self, user_id) -> int:
+        return self._unsummarized.get(user_id, 0)
+
+    def load(self, user_id, turns, summary=None, unsummarized: int = 0) -> None:
+        self.invalidate(user_id)
+        self._entries[user_id] = deque(turns, maxlen=self.max_turns)
+        self._unsummarized[user_id] = unsummarized
+        if summary:
+            self._summaries[user_id] = summary
+        self._resize(user_id)
+        self._evict()
+
+    def append(self, user_id, is_sent_by_user: bool, text: str) -> None:
+        # Sans entrée on ne sait pas ce qui précède : le prochain accès relira la base
+        turns = self._entries.get(user_id)
+        if turns is None:
+            return
+        turns.append((is_sent_by_user, text))
+        self._unsummarized[user_id] += 1
+        self._entries.move_to_end(user_id)
+        self._resize(user_id)
+        self._evict()
+
+    def set_summary(self, user_id, summary: str, folded: int = 0) -> None:
+        """Store the new summary, which now also covers ``folded`` more messages."""
+        if user_id in self._entries:
+            self._summaries[user_id] = summary
+            self._unsummarized[user_id] = max(0, self._unsummarized[user_id] - folded)
+            self._resize(user_id)
+            self._evict()
+
+    def invalidate(self, user_id) -> None:
+        if self._entries.pop(user_id, None) is not None:
+            self._summaries.pop(user_id, None)
+            self._unsummarized.pop(user_id, None)
+            self.total_bytes -= self._sizes.pop(user_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'users': len(self._entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def _resize(self, user_id) -> None:
+        size = sum(sys.getsizeof(text) for _, text in self._entries[user_id])
+        size += sys.getsizeof(self._summaries.get(user_id, ''))
+        self.total_bytes += size - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = size
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_users or self.total_bytes > self.max_bytes):
+            user_id, _ = self._entries.popitem(last=False)
+            self._summaries.pop(user_id, None)
+            self._unsummarized.pop(user_id, None)
+            self.total_bytes -= self._sizes.pop(user_id)
+            self.evictions += 1
+
+history_cache = HistoryCache(HISTORY_TURNS, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_BYTES)
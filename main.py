@@ -1,36 +1,176 @@
 #!/usr/bin/env python
+import asyncio
+import multiprocessing
 import os
+import signal
 from dotenv import load_dotenv
 import logging
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.constants import ChatAction
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, TypeHandler, filters
 
-from handlers import start, handle_message, audio_handler, cancel, manage, collect_feedback
+import metrics
+from profiler import profiler
 
 load_dotenv()
 
+# Nombre maximum d'updates traitées en parallèle par le worker
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 64))
+# Updates reçues en attente de traitement ; au-delà le webhook attend
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+
+# "webhook" ou "polling"
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+DOMAIN = os.getenv('DOMAIN')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', f"https://{DOMAIN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', 'cert.pem')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', 'key.pem')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+# Autre serveur de l'API Bot (serveur local ou faux serveur de test)
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
+
+# Process qui traitent les updates, chacun pour une partie des utilisateurs (par user_id)
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+
+# Les handlers ne traitent que des messages
+ALLOWED_UPDATES = [Update.MESSAGE]
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+async def post_shutdown(application: Application) -> None:
+    import openai_client
+    from database import dispose_engines
+    from message_buffer import message_buffer
+    from rollups import rollup_buffer
+
+    await openai_client.close()
+    await message_buffer.close()
+    await rollup_buffer.close()
+    await dispose_engines()
+
+def application_builder():
+    builder = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    return builder
+
+def build_application(receive_updates: bool = True) -> Application:
+    builder = (
+        application_builder()
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_shutdown(post_shutdown)
+    )
+    if not receive_updates:
+        # Worker d'un bot partitionné : les updates viennent du routeur
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Importés ici : le routeur d'un bot partitionné n'en a pas besoin (OpenAI, tiktoken...)
+    from handlers import start, handle_message, audio_handler, cancel, manage, collect_feedback
+    from scheduler import scheduled
+    from context_builder import preload_encoding
+
+    preload_encoding()
+
+    # Add handlers
+    # Les updates d'un même utilisateur sont traitées dans l'ordre (voir scheduler)
+    application.add_handler(CommandHandler("start", scheduled(start, uses_openai=False)))
+    application.add_handler(CommandHandler("manage", scheduled(manage, uses_openai=False)))
+    application.add_handler(CommandHandler("cancel", scheduled(cancel, uses_openai=False)))
+    application.add_handler(CommandHandler("feedback", scheduled(collect_feedback, uses_openai=False)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, scheduled(handle_message)))
+    application.add_handler(MessageHandler(filters.VOICE & ~filters.COMMAND, scheduled(audio_handler, action=ChatAction.RECORD_VOICE)))
+    return application
+
+def shard_for(update: Update, workers: int) -> int:
+    user = update.effective_user
+    return user.id % workers if user else 0
+
+async def serve_shard(index: int, updates) -> None:
+    application = build_application(receive_updates=False)
+    await application.initialize()
+    await application.start()
+    logger.info("Bot worker %s started", index)
+    while True:
+        data = await asyncio.to_thread(updates.get)
+        if data is None:
+            break
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    await application.stop()
+    await application.shutdown()
+    await post_shutdown(application)
+
+def run_shard(index: int, updates) -> None:
+    # Arrêté par le routeur, après les updates déjà reçues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    metrics.start_worker_server(offset=index + 1)
+    profiler.start()
+    asyncio.run(serve_shard(index, updates))
+
+def build_router(queues) -> Application:
+    """Receive the updates and pass each one to the worker that owns its user."""
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Mise en file bloquante : si un worker est saturé, la réception attend
+        await asyncio.to_thread(queues[shard_for(update, len(queues))].put, update.to_dict())
+
+    # Une update à la fois : l'ordre des messages d'un utilisateur est conservé
+    application = application_builder().build()
+    application.add_handler(TypeHandler(Update, route))
+    return application
+
 def main() -> None:
     """Run the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+    queues, workers = [], []
+    if BOT_WORKERS > 1:
+        context = multiprocessing.get_context('spawn')
+        queues = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(BOT_WORKERS)]
+        workers = [
+            context.Process(target=run_shard, args=(index, queue), name=f'bot-worker-{index}')
+            for index, queue in enumerate(queues)
+        ]
+        for worker in workers:
+            worker.start()
+        application = build_router(queues)
+    else:
+        application = build_application()
+    metrics.start_worker_server()
+    profiler.start()
 
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("manage", manage))
-    application.add_handler(CommandHandler("cancel", cancel))
-    application.add_handler(CommandHandler("feedback", collect_feedback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.VOICE & ~filters.COMMAND, audio_handler))
-    
+    try:
+        run(application)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
 
+def run(application: Application) -> None:
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        # Certificat auto-signé : servi en HTTPS ici et transmis à Telegram
+        tls = os.path.exists(WEBHOOK_CERT) and os.path.exists(WEBHOOK_KEY)
+        logger.info("Receiving updates through the webhook at %s", WEBHOOK_URL)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            cert=WEBHOOK_CERT if tls else None,
+            key=WEBHOOK_KEY if tls else None,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, deque
+
+from sqlalchemy import bindparam, insert, update
+
+from database import AsyncSession, Message, User
+
+logger = logging.getLogger(__name__)
+
+# Écriture différée des messages : insérés par lots hors du chemin de la réponse
+MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', 'false').lower() == 'true'
+# Un lot part dès qu'il atteint cette taille, ou au plus tard après cet intervalle
+MESSAGE_FLUSH_SIZE = int(os.getenv('MESSAGE_FLUSH_SIZE', 200))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', 1.0))
+
+# Lots récents gardés pour compléter les lectures faites pendant un commit
+BATCH_HISTORY = 16
+
+USAGE_COLUMNS = ('prompt_tokens', 'cached_prompt_tokens', 'completion_tokens')
+
+users = User.__table__
+INCREMENT_MESSAGE_COUNT = (
+    update(users)
+    .where(users.c.user_id == bindparam('b_user_id'))
+    .values(message_count=users.c.message_count + bindparam('b_count'), message_batch=bindparam('b_batch'))
+)
+
+def message_row(user_id, text: str, is_sent_by_user: bool, usage: dict = None) -> dict:
+    # Mêmes clés pour toutes les lignes : un seul INSERT multi-lignes par lot
+    row = {'user_id': user_id, 'message': text, 'is_sent_by_user': is_sent_by_user}
+    row.update({column: (usage or {}).get(column) for column in USAGE_COLUMNS})
+    return row
+
+class MessageBuffer:
+    """Collect Message rows and insert them in bulk from a background task.
+
+    Each batch also adds the user's messages to ``users.message_count`` in the
+    same transaction and stamps ``users.message_batch`` with the batch number.
+    ``pending_count`` compares that number with the batch being written, so a
+    user row read at any moment is completed exactly, without a lock.
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._inflight = []
+        # user_id -> messages envoyés par l'utilisateur pas encore dans un lot
+        self._counts = Counter()
+        # (numéro, comptes par user_id) des derniers lots, en cours d'écriture compris : une
+        # ligne lue juste avant un commit est complétée même si pending_count vient après.
+        # Numéros croissants, aussi d'un redémarrage à l'autre.
+        self._batches = deque(maxlen=BATCH_HISTORY)
+        self._last_batch = 0
+        self._flushing = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, row: dict) -> None:
+        self._rows.append(row)
+        if row['is_sent_by_user']:
+            self._counts[row['user_id']] += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if len(self._rows) >= self.flush_size:
+            self._wakeup.set()
+
+    def pending_count(self, user_id, applied_batch: int) -> int:
+        """Messages of the user missing from a row whose message_batch is ``applied_batch``."""
+        count = self._counts.get(user_id, 0)
+        for batch, counts in self._batches:
+            if batch > (applied_batch or 0):
+                count += counts.get(user_id, 0)
+        return count
+
+    def pending_turns(self, user_id) -> list:
+        return [(row['is_sent_by_user'], row['message']) for row in self._inflight + self._rows if row['user_id'] == user_id]
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Could not write %s buffered messages, retrying", len(self._rows))
+
+    async def flush(self) -> None:
+        async with self._flushing:
+            if not self._rows:
+                return
+            batch = max(time.time_ns(), self._last_batch + 1)
+            self._last_batch = batch
+            self._inflight, self._rows = self._rows, []
+            counts, self._counts = self._counts, Counter()
+            entry = (batch, counts)
+            self._batches.append(entry)
+            try:
+                async with AsyncSession() as session:
+                    await session.execute(insert(Message), self._inflight)
+                    if counts:
+                        await session.execute(
+                            INCREMENT_MESSAGE_COUNT,
+                            [{'b_user_id': user_id, 'b_count': count, 'b_batch': batch} for user_id, count in counts.items()]
+                        )
+                    await session.commit()
+            except BaseException:
+                # Remis en tête pour garder l'ordre : réécrits au prochain lot
+                self._rows[:0] = self._inflight
+                self._counts.update(counts)
+                self._batches.remove(entry)
+                raise
+            finally:
+                self._inflight = []
+
+    async def close(self) -> None:
+        """Stop the background task and write what is left."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+message_buffer = MessageBuffer(MESSAGE_FLUSH_SIZE, MESSAGE_FLUSH_INTERVAL)
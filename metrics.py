@@ -0,0 +1,111 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess, start_http_server,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Port du serveur /metrics du worker (désactivé si vide)
+METRICS_PORT = os.getenv('METRICS_PORT')
+# Jeton demandé par le /metrics de l'application web (en-tête Authorization: Bearer)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Un tour complet dure souvent plusieurs secondes (GPT, Whisper, TTS)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+STAGE_SECONDS = Histogram('coachia_stage_seconds', "Time spent in each stage of a reply", ['stage'], buckets=BUCKETS)
+HTTP_REQUEST_SECONDS = Histogram(
+    'coachia_http_request_seconds', "Time spent serving the web routes", ['route', 'method', 'status'], buckets=BUCKETS
+)
+OPENAI_TOKENS = Counter('coachia_openai_tokens', "Tokens billed by OpenAI", ['kind'])
+HEDGED_REQUESTS = Counter('coachia_openai_hedged_requests', "Hedged completions by model that answered first", ['winner'])
+
+@contextmanager
+def span(stage: str):
+    """Time the block into the ``stage`` histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+def observe(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+def record_tokens(usage: dict) -> None:
+    for kind in ('prompt_tokens', 'cached_prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            OPENAI_TOKENS.labels(kind.replace('_tokens', '')).inc(usage[kind])
+
+class CacheCollector:
+    """Expose the in-process caches' own counters at scrape time."""
+
+    def collect(self):
+        from history_cache import history_cache
+        from tts_cache import tts_cache
+
+        history = history_cache.stats()
+        tts = tts_cache.stats()
+        lookups = CounterMetricFamily('coachia_cache_lookups', "Lookups in the in-process caches", labels=['cache', 'result'])
+        lookups.add_metric(['history', 'hit'], history['hits'])
+        lookups.add_metric(['history', 'miss'], history['misses'])
+        lookups.add_metric(['tts', 'memory_hit'], tts['memory_hits'])
+        lookups.add_metric(['tts', 'disk_hit'], tts['disk_hits'])
+        lookups.add_metric(['tts', 'file_id_hit'], tts['file_id_hits'])
+        lookups.add_metric(['tts', 'miss'], tts['misses'])
+        yield lookups
+        size = GaugeMetricFamily('coachia_history_cache_bytes', "Size of the cached conversation texts")
+        size.add_metric([], history['bytes'])
+        yield size
+        users = GaugeMetricFamily('coachia_history_cache_users', "Users whose history is cached")
+        users.add_metric([], history['users'])
+        yield users
+
+def start_worker_server(offset: int = 0) -> None:
+    """Serve /metrics for the bot worker if METRICS_PORT is set.
+
+    Each worker of a sharded bot uses the port METRICS_PORT + ``offset``.
+    """
+    if not METRICS_PORT:
+        return
+    REGISTRY.register(CacheCollector())
+    start_http_server(int(METRICS_PORT) + offset)
+    logger.info("Serving metrics on port %s", int(METRICS_PORT) + offset)
+
+def render():
+    # Plusieurs workers gunicorn : agrégés si PROMETHEUS_MULTIPROC_DIR est défini
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def instrument(app) -> None:
+    """Time the routes of a Flask ``app`` and serve /metrics on it."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            # La règle et non l'URL : pas une série par user_id
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_REQUEST_SECONDS.labels(route, request.method, response.status_code).observe(time.perf_counter() - start)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+            return "Unauthorized", 401
+        body, content_type = render()
+        return Response(body, content_type=content_type)
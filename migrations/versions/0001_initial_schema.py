@@ -0,0 +1,65 @@
+"""Initial schema
+
+Tables as they existed before migrations were introduced. Tables that are
+already there (the production database created with `create_all`) are left
+untouched, so `alembic upgrade head` works on both fresh and existing
+databases.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if 'users' not in existing:
+        op.create_table(
+            'users',
+            sa.Column('user_id', sa.Integer(), primary_key=True, nullable=False),
+            sa.Column('stripe_customer_id', sa.String(255), nullable=True),
+            sa.Column('username', sa.String(255)),
+            sa.Column('created_at', sa.DateTime()),
+        )
+    if 'messages' not in existing:
+        op.create_table(
+            'messages',
+            sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id'), nullable=False),
+            sa.Column('message', sa.Text(), nullable=False),
+            sa.Column('is_sent_by_user', sa.Boolean(), nullable=False),
+            sa.Column('created_at', sa.DateTime()),
+        )
+    if 'subscriptions' not in existing:
+        op.create_table(
+            'subscriptions',
+            sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id'), nullable=False),
+            sa.Column('start_date', sa.DateTime()),
+            sa.Column('end_date', sa.DateTime()),
+            sa.Column('created_at', sa.DateTime()),
+        )
+    if 'feedback' not in existing:
+        op.create_table(
+            'feedback',
+            sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id'), nullable=False),
+            sa.Column('feedback_text', sa.Text(), nullable=False),
+            sa.Column('created_at', sa.DateTime()),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table('feedback')
+    op.drop_table('subscriptions')
+    op.drop_table('messages')
+    op.drop_table('users')
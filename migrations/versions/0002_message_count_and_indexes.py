@@ -0,0 +1,88 @@
+"""users.message_count and indexes for the hot query paths
+
+On MySQL the DDL runs with ALGORITHM=INPLACE, LOCK=NONE so reads and writes
+continue while the indexes are built. The message_count backfill runs in
+autocommit mode, a batch of users at a time.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 500
+
+INDEXES = [
+    ('ix_messages_user_id_is_sent_by_user', 'messages', ['user_id', 'is_sent_by_user']),
+    ('ix_messages_user_id_created_at', 'messages', ['user_id', 'created_at']),
+    ('ix_subscriptions_user_id_created_at', 'subscriptions', ['user_id', 'created_at']),
+    ('ix_users_stripe_customer_id', 'users', ['stripe_customer_id']),
+]
+
+
+def _is_mysql() -> bool:
+    return op.get_bind().dialect.name == 'mysql'
+
+
+def _create_index(name, table, columns) -> None:
+    if name in {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}:
+        return
+    if _is_mysql():
+        op.execute(f"ALTER TABLE {table} ADD INDEX {name} ({', '.join(columns)}), ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        op.create_index(name, table, columns)
+
+
+def _backfill_message_count() -> None:
+    users = sa.table('users', sa.column('user_id'), sa.column('message_count'))
+    messages = sa.table('messages', sa.column('user_id'), sa.column('is_sent_by_user'))
+    sent_count = (
+        sa.select(sa.func.count())
+        .where(messages.c.user_id == users.c.user_id, messages.c.is_sent_by_user == sa.true())
+        .scalar_subquery()
+    )
+
+    bind = op.get_bind()
+    last_user_id = None
+    while True:
+        query = sa.select(users.c.user_id).order_by(users.c.user_id).limit(BACKFILL_BATCH_SIZE)
+        if last_user_id is not None:
+            query = query.where(users.c.user_id > last_user_id)
+        user_ids = [row[0] for row in bind.execute(query)]
+        if not user_ids:
+            return
+        bind.execute(
+            users.update()
+            .where(users.c.user_id.in_(user_ids))
+            .values(message_count=sent_count)
+        )
+        last_user_id = user_ids[-1]
+
+
+def upgrade() -> None:
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('users')}
+    if 'message_count' not in columns:
+        if _is_mysql():
+            op.execute("ALTER TABLE users ADD COLUMN message_count INT NOT NULL DEFAULT 0, ALGORITHM=INPLACE, LOCK=NONE")
+        else:
+            op.add_column('users', sa.Column('message_count', sa.Integer(), nullable=False, server_default='0'))
+
+    for name, table, columns in INDEXES:
+        _create_index(name, table, columns)
+
+    # Chaque lot est validé séparément pour ne pas verrouiller toute la table users
+    with op.get_context().autocommit_block():
+        _backfill_message_count()
+
+
+def downgrade() -> None:
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    op.drop_column('users', 'message_count')
@@ -0,0 +1,32 @@
+"""processed_events table for Stripe webhook deduplication
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'processed_events',
+        sa.Column('event_id', sa.String(255), primary_key=True),
+        sa.Column('event_type', sa.String(255), nullable=False),
+        sa.Column('payload', sa.Text().with_variant(mysql.MEDIUMTEXT(), 'mysql'), nullable=False),
+        sa.Column('received_at', sa.DateTime()),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_processed_events_processed_at', 'processed_events', ['processed_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_processed_events_processed_at', table_name='processed_events')
+    op.drop_table('processed_events')
@@ -0,0 +1,28 @@
+"""conversation_summaries table for rolling per-user summaries
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'conversation_summaries',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id'), primary_key=True),
+        sa.Column('summary', sa.Text(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('conversation_summaries')
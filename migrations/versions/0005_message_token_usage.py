@@ -0,0 +1,30 @@
+"""Token usage columns on messages
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+COLUMNS = ['prompt_tokens', 'cached_prompt_tokens', 'completion_tokens']
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'mysql':
+        columns = ", ".join(f"ADD COLUMN {name} INT NULL" for name in COLUMNS)
+        op.execute(f"ALTER TABLE messages {columns}, ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        for name in COLUMNS:
+            op.add_column('messages', sa.Column(name, sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    for name in reversed(COLUMNS):
+        op.drop_column('messages', name)
@@ -0,0 +1,35 @@
+"""message_archives table for archived messages
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import MEDIUMBLOB
+
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'message_archives',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id'), nullable=False),
+        sa.Column('month', sa.String(7), nullable=False),
+        sa.Column('first_message_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=False),
+        sa.Column('message_count', sa.Integer(), nullable=False),
+        sa.Column('data', sa.LargeBinary().with_variant(MEDIUMBLOB(), 'mysql'), nullable=False),
+        sa.Column('created_at', sa.DateTime()),
+    )
+    op.create_index('ix_message_archives_user_id_first_message_id', 'message_archives', ['user_id', 'first_message_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_message_archives_user_id_first_message_id', table_name='message_archives')
+    op.drop_table('message_archives')
@@ -0,0 +1,28 @@
+"""user_states table for per-user conversation state
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'user_states',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id'), primary_key=True),
+        sa.Column('key', sa.String(64), primary_key=True),
+        sa.Column('value', sa.Text(), nullable=False),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('user_states')
@@ -0,0 +1,30 @@
+"""Cached Stripe Checkout session on users
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'mysql':
+        op.execute(
+            "ALTER TABLE users ADD COLUMN checkout_session_url TEXT NULL, "
+            "ADD COLUMN checkout_session_expires_at DATETIME NULL, ALGORITHM=INPLACE, LOCK=NONE"
+        )
+    else:
+        op.add_column('users', sa.Column('checkout_session_url', sa.Text(), nullable=True))
+        op.add_column('users', sa.Column('checkout_session_expires_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'checkout_session_expires_at')
+    op.drop_column('users', 'checkout_session_url')
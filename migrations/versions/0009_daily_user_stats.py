@@ -0,0 +1,29 @@
+"""daily_user_stats table for usage and conversion rollups
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+COUNTERS = ['user_messages', 'voice_messages', 'replies', 'paywall_hits', 'feedback', 'payments', 'conversions']
+
+
+def upgrade() -> None:
+    op.create_table(
+        'daily_user_stats',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.user_id'), primary_key=True),
+        *[sa.Column(name, sa.Integer(), nullable=False, server_default='0') for name in COUNTERS],
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('daily_user_stats')
@@ -0,0 +1,30 @@
+"""Subscription end date on users
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'mysql':
+        op.execute("ALTER TABLE users ADD COLUMN subscription_end_date DATETIME NULL, ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        op.add_column('users', sa.Column('subscription_end_date', sa.DateTime(), nullable=True))
+    # Fin de la dernière période déjà payée
+    op.execute(
+        "UPDATE users SET subscription_end_date = "
+        "(SELECT MAX(end_date) FROM subscriptions WHERE subscriptions.user_id = users.user_id)"
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'subscription_end_date')
@@ -0,0 +1,25 @@
+"""Last write-behind message batch counted on users
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'mysql':
+        op.execute("ALTER TABLE users ADD COLUMN message_batch BIGINT NOT NULL DEFAULT 0, ALGORITHM=INPLACE, LOCK=NONE")
+    else:
+        op.add_column('users', sa.Column('message_batch', sa.BigInteger(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'message_batch')
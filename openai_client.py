@@ -1,39 +1,231 @@
 import os
 from dotenv import load_dotenv
-import openai
-from pathlib import Path
-import uuid
+import httpx
+from openai import AsyncOpenAI
+import asyncio
+import io
+import time
+from typing import AsyncIterator
+
+from tts_cache import tts_cache, cache_key
+from scheduler import limiter, ESTIMATED_TURN_TOKENS
+from metrics import span, observe, record_tokens, HEDGED_REQUESTS
+from hedging import hedged, latencies
 
 load_dotenv()
-openai.api_key = os.getenv('OPEN_AI_KEY')
-
-def generate_response(conversation_history: str, user_message: str) -> str:
-    completion = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": f"You are Julie, a therapist and personal coach. You help people feel heard and supported. Don't hesitate to ask questions to fully understand people's problems. Be attentive and kind. Keep your messages short. Here is our conversation history: {conversation_history}"},
-            {"role": "user", "content": user_message}
-        ]
-    )
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20))
+
+CHAT_MODEL = os.getenv('CHAT_MODEL', 'gpt-4o')
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
+# Réponse complète (ou premier token en streaming) attendue au plus ce délai
+COMPLETION_DEADLINE = float(os.getenv('COMPLETION_DEADLINE', 30))
+# Requête de secours vers un modèle plus rapide quand le modèle principal tarde
+OPENAI_HEDGING = os.getenv('OPENAI_HEDGING', 'false').lower() == 'true'
+FALLBACK_MODEL = os.getenv('FALLBACK_MODEL', 'gpt-4o-mini')
+# Tokens réservés pour la réponse d'un résumé (200 mots au plus)
+SUMMARY_COMPLETION_TOKENS = 400
+
+TTS_VOICE = "alloy"
+TTS_MODEL = "tts-1"
+TTS_FORMAT = "opus"
+
+async def on_response(response: httpx.Response) -> None:
+    # Un 429 ralentit toutes les conversations, pas seulement celle qui l'a reçu
+    if response.status_code == 429:
+        try:
+            retry_after = float(response.headers.get('retry-after', 1))
+        except ValueError:
+            retry_after = 1.0
+        limiter.backoff(retry_after)
+
+# Un seul client HTTP partagé : les connexions TLS vers l'API sont réutilisées
+# entre les conversations au lieu d'être rouvertes à chaque appel.
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    event_hooks={'response': [on_response]},
+)
+
+client = AsyncOpenAI(api_key=os.getenv('OPEN_AI_KEY'), http_client=http_client)
+
+# Identique d'un tour à l'autre : début de prompt commun, mis en cache par OpenAI
+SYSTEM_PROMPT = "You are Julie, a therapist and personal coach. You help people feel heard and supported. Don't hesitate to ask questions to fully understand people's problems. Be attentive and kind. Keep your messages short."
+
+def build_messages(conversation_history: list, user_message: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *conversation_history,
+        {"role": "user", "content": user_message}
+    ]
+
+def record_usage(usage, completion_usage) -> None:
+    if completion_usage is None:
+        return
+    details = getattr(completion_usage, 'prompt_tokens_details', None)
+    counts = {
+        'prompt_tokens': completion_usage.prompt_tokens,
+        'cached_prompt_tokens': getattr(details, 'cached_tokens', None) or 0,
+        'completion_tokens': completion_usage.completion_tokens,
+    }
+    record_tokens(counts)
+    if usage is not None:
+        usage.update(counts)
+
+def chat_models() -> list:
+    return [CHAT_MODEL, FALLBACK_MODEL] if OPENAI_HEDGING and FALLBACK_MODEL != CHAT_MODEL else [CHAT_MODEL]
+
+async def complete(model: str, messages: list):
+    with latencies.timing(('completion', model)):
+        return await client.chat.completions.create(model=model, messages=messages)
+
+def admit_hedge(messages: list):
+    """Charge a hedged request to the OpenAI budget, like the turn it belongs to."""
+    tokens = ESTIMATED_TURN_TOKENS + len(messages[-1]["content"]) // 4
+    return lambda: limiter.reserve(tokens)
+
+async def generate_response(conversation_history: list, user_message: str, usage: dict = None) -> str:
+    """Return the reply. ``usage`` is filled with the token counts, cached ones included.
+
+    Fails with ``asyncio.TimeoutError`` after COMPLETION_DEADLINE seconds.
+    """
+    messages = build_messages(conversation_history, user_message)
+    with span('openai.chat'):
+        model, completion = await asyncio.wait_for(
+            hedged(
+                lambda model: complete(model, messages),
+                chat_models(),
+                latencies.hedge_delay(('completion', CHAT_MODEL)),
+                admit=admit_hedge(messages)
+            ),
+            COMPLETION_DEADLINE
+        )
+    count_hedge(model)
+    record_usage(usage, completion.usage)
     return completion.choices[0].message.content
 
-def transcribe_audio(audio_file_path: str) -> str:
-    audio_file = open(audio_file_path, "rb")
-    transcription = openai.audio.transcriptions.create(
-        model="whisper-1",
-        file=audio_file,
-        response_format="text",
-        language="fr"
+async def open_stream(model: str, messages: list):
+    """Start a streamed completion and wait for its first token.
+
+    Returns the stream's iterator and the chunks read so far.
+    """
+    with latencies.timing(('first_token', model)):
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        chunks = []
+        iterator = stream.__aiter__()
+        try:
+            async for chunk in iterator:
+                chunks.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except BaseException:
+            await stream.close()
+            raise
+    return stream, iterator, chunks
+
+async def close_stream(opened) -> None:
+    await opened[0].close()
+
+def count_hedge(model: str) -> None:
+    if model != CHAT_MODEL:
+        HEDGED_REQUESTS.labels('fallback').inc()
+    elif OPENAI_HEDGING:
+        HEDGED_REQUESTS.labels('primary').inc()
+
+async def stream_response(conversation_history: list, user_message: str, usage: dict = None) -> AsyncIterator[str]:
+    """Yield the reply text piece by piece as the tokens arrive.
+
+    ``usage`` is filled with the token counts once the stream is complete.
+    The first token must arrive within COMPLETION_DEADLINE seconds.
+    """
+    start = time.perf_counter()
+    messages = build_messages(conversation_history, user_message)
+    model, (stream, iterator, chunks) = await asyncio.wait_for(
+        hedged(
+            lambda model: open_stream(model, messages),
+            chat_models(),
+            latencies.hedge_delay(('first_token', CHAT_MODEL)),
+            discard=close_stream,
+            admit=admit_hedge(messages)
+        ),
+        COMPLETION_DEADLINE
     )
+    count_hedge(model)
+    observe('openai.chat_first_token', time.perf_counter() - start)
+
+    async def remaining():
+        for chunk in chunks:
+            yield chunk
+        async for chunk in iterator:
+            yield chunk
+
+    try:
+        async for chunk in remaining():
+            if chunk.usage is not None:
+                record_usage(usage, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+    observe('openai.chat', time.perf_counter() - start)
+
+async def summarize(previous_summary: str, transcript: str) -> str:
+    # Compté dans le budget RPM/TPM comme les réponses : un rattrapage de
+    # résumés ne provoque pas de 429 qui ralentiraient toutes les conversations
+    await limiter.reserve(SUMMARY_COMPLETION_TOKENS + (len(previous_summary) + len(transcript)) // 4)
+    with span('openai.summary'):
+        completion = await client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "You keep a running summary of a conversation between a user and Julie, their therapist and personal coach. Update the summary with the new exchanges. Keep the facts, feelings, goals and advice that matter for future sessions. Write at most 200 words, in the user's language."},
+                {"role": "user", "content": f"Current summary:\n{previous_summary or '(none)'}\n\nNew exchanges:\n{transcript}"}
+            ]
+        )
+    record_usage(None, completion.usage)
+    return completion.choices[0].message.content
+
+async def transcribe_audio(audio: bytes, filename: str = "voice.ogg") -> str:
+    with span('openai.transcription'):
+        transcription = await client.audio.transcriptions.create(
+            model="whisper-1",
+            file=(filename, audio),
+            response_format="text",
+            language="fr"
+        )
     return transcription
 
-def create_speech(text: str, voice: str = "alloy", model: str = "tts-1") -> str:
-    unique_filename = f"response_voice_{uuid.uuid4()}.ogg"
-    speech_file_path = Path(unique_filename)
-    response = openai.audio.speech.create(
-        model=model,
-        voice=voice,
-        input=text
-    )
-    response.stream_to_file(speech_file_path)
-    return str(speech_file_path)
\ No newline at end of file
+def speech_cache_key(text: str, voice: str = TTS_VOICE, model: str = TTS_MODEL) -> str:
+    return cache_key(text, voice, model, TTS_FORMAT)
+
+async def create_speech(text: str, voice: str = TTS_VOICE, model: str = TTS_MODEL) -> bytes:
+    key = speech_cache_key(text, voice, model)
+    audio = await tts_cache.get(key)
+    if audio is not None:
+        return audio
+
+    # Opus est le codec des notes vocales Telegram : pas de conversion à l'envoi
+    buffer = io.BytesIO()
+    with span('openai.speech'):
+        async with client.audio.speech.with_streaming_response.create(
+            model=model,
+            voice=voice,
+            input=text,
+            response_format=TTS_FORMAT
+        ) as response:
+            async for chunk in response.iter_bytes():
+                buffer.write(chunk)
+    audio = buffer.getvalue()
+    await tts_cache.put(key, audio)
+    return audio
+
+async def close() -> None:
+    await http_client.aclose()
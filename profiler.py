@@ -0,0 +1,76 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Intervalle d'échantillonnage en secondes ; 0 désactive le profileur
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0))
+# Fichier de sortie, un par process
+PROFILER_OUTPUT = os.getenv('PROFILER_OUTPUT', 'profile-{pid}.folded')
+PROFILER_FLUSH_INTERVAL = float(os.getenv('PROFILER_FLUSH_INTERVAL', 60))
+
+class SamplingProfiler:
+    """Sample the stack of every thread at a fixed interval.
+
+    The counts are written as folded stacks (one ``frame;frame;frame count``
+    line per stack), which flamegraph.pl and speedscope read. Sampling is
+    wall-clock: threads waiting on I/O show up too.
+    """
+
+    def __init__(self, interval: float, output: str, flush_interval: float):
+        self.interval = interval
+        self.output = output
+        self.flush_interval = flush_interval
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self) -> None:
+        if not self.interval or self._pid == os.getpid():
+            return
+        # Un thread par process, démarré après le fork de gunicorn
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.counts.clear()
+            threading.Thread(target=self._run, name='profiler', daemon=True).start()
+        logger.info("Sampling profiler started, writing to %s", self.output.format(pid=os.getpid()))
+
+    def _run(self) -> None:
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            if time.monotonic() >= next_flush:
+                next_flush = time.monotonic() + self.flush_interval
+                try:
+                    self.flush()
+                except OSError:
+                    logger.exception("Could not write the profile")
+
+    def sample(self) -> None:
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def flush(self) -> None:
+        # Totaux depuis le démarrage, le fichier est remplacé d'un coup
+        path = self.output.format(pid=os.getpid())
+        with open(f"{path}.tmp", 'w') as f:
+            for stack, count in self.counts.items():
+                f.write(f"{stack} {count}\n")
+        os.replace(f"{path}.tmp", path)
+
+profiler = SamplingProfiler(PROFILER_INTERVAL, PROFILER_OUTPUT, PROFILER_FLUSH_INTERVAL)
@@ -0,0 +1,24 @@
+import os
+from datetime import datetime, timezone
+
+# Nombre de messages gratuits avant d'exiger un abonnement
+FREE_MESSAGE_LIMIT = int(os.getenv('FREE_MESSAGE_LIMIT', 10))
+
+# Textes fixes du bot, lus aussi par les rapports (rollups) et les benchmarks
+PAYWALL_TEXT = "You have reached the message limit 🙁 \n \nTo continue our conversation, a subscription of $9.99/month (no commitment) is required.\n \nI am available 24/7, always here to help you through tough times and to become the best version of yourself \n\nClick on 'Continue chatting' to no longer face your problems alone."
+FEEDBACK_THANKS_TEXT = "Thank you very much for your valuable feedback! We will take it into account. \n \nYou can now resume your normal conversation."
+# Envoyés par le site (stripe_checkout) et enregistrés comme messages du bot :
+# ce ne sont pas des réponses, les rollups ne les comptent pas
+ALREADY_SUBSCRIBED_TEXT = "You already have a subscription"
+PAYMENT_SUCCESS_TEXT = "Your payment was successful."
+PAYMENT_CANCELED_TEXT = "Your payment has been canceled. If you wish to continue using the service, please try again."
+NOTIFICATION_TEXTS = (ALREADY_SUBSCRIBED_TEXT, PAYMENT_SUCCESS_TEXT, PAYMENT_CANCELED_TEXT)
+
+def _naive_utc(end_date):
+    if end_date is not None and end_date.tzinfo is not None:
+        end_date = end_date.astimezone(timezone.utc).replace(tzinfo=None)
+    return end_date
+
+def is_subscription_active(end_date) -> bool:
+    end_date = _naive_utc(end_date)
+    return end_date is not None and end_date >= datetime.utcnow()
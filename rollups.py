@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""Daily usage and conversion counters per user, and the reports built on them.
+
+The bot and the Stripe webhook add to ``daily_user_stats`` as events happen;
+reports only read that table, never ``messages`` or ``subscriptions``.
+
+    python rollups.py backfill [--since 2024-01-01] [--until 2026-10-17]   # jours passés, reconstruits
+    python rollups.py report [--days 30] [--json]
+
+The backfill cannot tell voice messages from text ones (``messages`` does not
+record it): ``voice_messages`` is only counted from the deployment on.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, case, delete, exists, func, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import aliased
+
+from archive import decompress
+from database import AsyncSession, Session, DailyUserStats, Feedback, Message, MessageArchive, Subscription
+from quota import PAYWALL_TEXT, NOTIFICATION_TEXTS
+
+logger = logging.getLogger(__name__)
+
+# Les compteurs du bot sont écrits par lots, au plus tard après cet intervalle
+ROLLUP_FLUSH_INTERVAL = float(os.getenv('ROLLUP_FLUSH_INTERVAL', 10.0))
+# Lignes source lues par transaction pendant le backfill, et pause entre deux transactions
+ROLLUP_CHUNK_SIZE = int(os.getenv('ROLLUP_CHUNK_SIZE', 5000))
+ROLLUP_CHUNK_PAUSE = float(os.getenv('ROLLUP_CHUNK_PAUSE', 0.1))
+
+COUNTERS = ('user_messages', 'voice_messages', 'replies', 'paywall_hits', 'feedback', 'payments', 'conversions')
+
+INSERTS = {'mysql': mysql.insert, 'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+def increment(dialect_name: str, counts: Counter):
+    """One upsert adding ``counts`` ({(day, user_id, counter): n}) to the rollups."""
+    rows = {}
+    for (day, user_id, counter), n in counts.items():
+        row = rows.setdefault((day, user_id), {'day': day, 'user_id': user_id, **dict.fromkeys(COUNTERS, 0)})
+        row[counter] += n
+    table = DailyUserStats.__table__
+    # Toujours dans le même ordre : deux écritures concurrentes ne s'interbloquent pas
+    stmt = INSERTS[dialect_name](table).values([rows[key] for key in sorted(rows)])
+    if dialect_name == 'mysql':
+        return stmt.on_duplicate_key_update({name: table.c[name] + stmt.inserted[name] for name in COUNTERS})
+    return stmt.on_conflict_do_update(
+        index_elements=['day', 'user_id'],
+        set_={name: table.c[name] + stmt.excluded[name] for name in COUNTERS},
+    )
+
+def today() -> date:
+    return datetime.utcnow().date()
+
+def record(session, user_id, **counts) -> None:
+    """Add ``counts`` to today's rollup of the user, in the caller's transaction."""
+    counts = Counter({(today(), user_id, counter): n for counter, n in counts.items() if n})
+    if counts:
+        session.execute(increment(session.get_bind().dialect.name, counts))
+
+class RollupBuffer:
+    """Accumulate the bot's counters in memory and upsert them from a background task.
+
+    A crash loses at most ``flush_interval`` seconds of counts; ``backfill``
+    rebuilds past days exactly.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._counts = Counter()
+        self._flushing = asyncio.Lock()
+        self._task = None
+
+    def count(self, user_id, counter: str, n: int = 1) -> None:
+        self._counts[(today(), user_id, counter)] += n
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Could not write %s rollup counters, retrying", len(self._counts))
+
+    async def flush(self) -> None:
+        async with self._flushing:
+            if not self._counts:
+                return
+            counts, self._counts = self._counts, Counter()
+            try:
+                async with AsyncSession() as session:
+                    await session.execute(increment(session.bind.dialect.name, counts))
+                    await session.commit()
+            except BaseException:
+                # Rajoutés aux compteurs accumulés entre-temps : réécrits au prochain lot
+                self._counts.update(counts)
+                raise
+
+    async def close(self) -> None:
+        """Stop the background task and write what is left."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+rollup_buffer = RollupBuffer(ROLLUP_FLUSH_INTERVAL)
+
+# Backfill
+
+def to_day(value) -> date:
+    # DATE() renvoie une date sous MySQL, une chaîne sous SQLite
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+def in_period(column, since, until):
+    conditions = [column < datetime.combine(until, datetime.min.time())]
+    if since is not None:
+        conditions.append(column >= datetime.combine(since, datetime.min.time()))
+    return and_(*conditions)
+
+def message_counter(is_sent_by_user, text):
+    """Rollup counter of a logged message, as the bot counts it live (None: not counted)."""
+    if is_sent_by_user:
+        return 'user_messages'
+    if text == PAYWALL_TEXT:
+        return 'paywall_hits'
+    # Notifications du site : le bot ne les compte pas comme des réponses
+    return None if text in NOTIFICATION_TEXTS else 'replies'
+
+def count_messages(session, first_id, last_id, since, until) -> Counter:
+    day = func.date(Message.created_at)
+    # Seuls les messages du bot au texte fixe sont lus : les réponses sont comptées sans leur texte
+    fixed = case((and_(Message.is_sent_by_user.is_(False), Message.message.in_((PAYWALL_TEXT,) + NOTIFICATION_TEXTS)), Message.message))
+    rows = session.execute(
+        select(day, Message.user_id, Message.is_sent_by_user, fixed, func.count())
+        .where(Message.id >= first_id, Message.id < last_id, in_period(Message.created_at, since, until))
+        .group_by(day, Message.user_id, Message.is_sent_by_user, fixed)
+    ).all()
+    counts = Counter()
+    for row_day, user_id, is_sent_by_user, text, n in rows:
+        counter = message_counter(is_sent_by_user, text)
+        if counter:
+            counts[(to_day(row_day), user_id, counter)] += n
+    return counts
+
+def count_archived_messages(session, first_id, last_id, since, until) -> Counter:
+    archives = session.execute(
+        select(MessageArchive).where(MessageArchive.id >= first_id, MessageArchive.id < last_id)
+    ).scalars().all()
+    counts = Counter()
+    for archive in archives:
+        for entry in decompress(archive.data):
+            if not entry['created_at']:
+                continue
+            day = datetime.fromisoformat(entry['created_at']).date()
+            if day >= until or (since is not None and day < since):
+                continue
+            counter = message_counter(entry['is_sent_by_user'], entry['message'])
+            if counter:
+                counts[(day, archive.user_id, counter)] += 1
+    return counts
+
+def count_feedback(session, first_id, last_id, since, until) -> Counter:
+    day = func.date(Feedback.created_at)
+    rows = session.execute(
+        select(day, Feedback.user_id, func.count())
+        .where(Feedback.id >= first_id, Feedback.id < last_id, in_period(Feedback.created_at, since, until))
+        .group_by(day, Feedback.user_id)
+    ).all()
+    return Counter({(to_day(row_day), user_id, 'feedback'): n for row_day, user_id, n in rows})
+
+def count_payments(session, first_id, last_id, since, until) -> Counter:
+    day = func.date(Subscription.created_at)
+    earlier = aliased(Subscription)
+    first = case((~exists().where(earlier.user_id == Subscription.user_id, earlier.id < Subscription.id), 1), else_=0)
+    rows = session.execute(
+        select(day, Subscription.user_id, func.count(), func.sum(first))
+        .where(Subscription.id >= first_id, Subscription.id < last_id, in_period(Subscription.created_at, since, until))
+        .group_by(day, Subscription.user_id)
+    ).all()
+    counts = Counter()
+    for row_day, user_id, payments, conversions in rows:
+        counts[(to_day(row_day), user_id, 'payments')] += payments
+        counts[(to_day(row_day), user_id, 'conversions')] += int(conversions or 0)
+    return counts
+
+# (table source, comptage, diviseur de la taille des lots)
+SOURCES = (
+    (Message, count_messages, 1),
+    # Une archive regroupe jusqu'à plusieurs centaines de messages
+    (MessageArchive, count_archived_messages, 100),
+    (Feedback, count_feedback, 1),
+    (Subscription, count_payments, 1),
+)
+
+def backfill(since=None, until=None, chunk_size: int = ROLLUP_CHUNK_SIZE, pause: float = ROLLUP_CHUNK_PAUSE) -> None:
+    """Rebuild the rollups of the days in [since, until) from the source tables, chunk by chunk.
+
+    ``until`` defaults to today, whose counters are kept as the bot wrote them.
+    The period is cleared first: run it again if it was interrupted.
+    """
+    until = until or today()
+    with Session() as session:
+        conditions = [DailyUserStats.day < until]
+        if since is not None:
+            conditions.append(DailyUserStats.day >= since)
+        session.execute(delete(DailyUserStats).where(*conditions))
+        session.commit()
+
+    for model, count, divisor in SOURCES:
+        step = max(1, chunk_size // divisor)
+        with Session() as session:
+            max_id = session.scalar(select(func.max(model.id))) or 0
+        first_id = 1
+        while first_id <= max_id:
+            with Session() as session:
+                counts = count(session, first_id, first_id + step, since, until)
+                if counts:
+                    session.execute(increment(session.get_bind().dialect.name, counts))
+                    session.commit()
+            first_id += step
+            logger.info("%s: %s/%s", model.__tablename__, min(first_id - 1, max_id), max_id)
+            # Laisse passer les écritures du bot entre deux lots
+            time.sleep(pause)
+
+# Rapports
+
+def report(session, since: date, until: date) -> list:
+    """Totals per day in [since, until), read from the rollups only."""
+    columns = [func.sum(getattr(DailyUserStats, name)).label(name) for name in COUNTERS]
+    active = func.sum(case((DailyUserStats.user_messages > 0, 1), else_=0)).label('active_users')
+    rows = session.execute(
+        select(DailyUserStats.day, active, *columns)
+        .where(DailyUserStats.day >= since, DailyUserStats.day < until)
+        .group_by(DailyUserStats.day)
+        .order_by(DailyUserStats.day)
+    ).all()
+    days = []
+    for row in rows:
+        # SUM() renvoie un Decimal sous MySQL
+        values = {name: int(getattr(row, name) or 0) for name in ('active_users',) + COUNTERS}
+        values['messages_per_user'] = round(values['user_messages'] / values['active_users'], 2) if values['active_users'] else 0.0
+        days.append({'day': to_day(row.day).isoformat(), **values})
+    return days
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('backfill', help="rebuild the rollups of past days from the source tables")
+    run.add_argument('--since', type=date.fromisoformat)
+    run.add_argument('--until', type=date.fromisoformat, help="first day not rebuilt (default: today)")
+    run.add_argument('--chunk-size', type=int, default=ROLLUP_CHUNK_SIZE)
+    show = commands.add_parser('report', help="print daily totals")
+    show.add_argument('--days', type=int, default=30)
+    show.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'backfill':
+        backfill(args.since, args.until, args.chunk_size)
+        return
+
+    until = today() + timedelta(days=1)
+    with Session() as session:
+        days = report(session, until - timedelta(days=args.days), until)
+    if args.json:
+        sys.stdout.write(json.dumps(days) + "\n")
+        return
+    headers = ('day', 'active_users', 'messages_per_user') + COUNTERS
+    print(" ".join(f"{header:>{max(len(header), 10)}}" for header in headers))
+    for values in days:
+        print(" ".join(f"{values[header]!s:>{max(len(header), 10)}}" for header in headers))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.constants import ChatAction
+from telegram.ext import ContextTypes
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Budget OpenAI du compte (requêtes et tokens par minute)
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', 500))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', 30000))
+# Nombre maximum de conversations en cours de traitement par OpenAI
+OPENAI_MAX_INFLIGHT = int(os.getenv('OPENAI_MAX_INFLIGHT', 32))
+# Estimation des tokens d'un tour (historique + réponse), hors message de l'utilisateur
+ESTIMATED_TURN_TOKENS = int(os.getenv('ESTIMATED_TURN_TOKENS', 800))
+# Attente maximale d'une place avant de répondre que Julie est occupée
+SCHEDULER_MAX_WAIT = float(os.getenv('SCHEDULER_MAX_WAIT', 120))
+
+# Une action « en train d'écrire » reste affichée 5 secondes
+CHAT_ACTION_INTERVAL = 4.0
+
+BUSY_TEXT = "I'm receiving a lot of messages right now 🙏 Please send me your message again in a few minutes."
+TIMEOUT_TEXT = "Sorry, I'm taking too long to answer 🙏 Please send me your message again."
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount: float) -> float:
+        """Seconds to wait before ``amount`` tokens are available."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def pause(self, seconds: float) -> None:
+        # Vider le seau : rien ne repart avant ``seconds``
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+class OpenAILimiter:
+    """Admit OpenAI work within the RPM/TPM budget and a cap on calls in flight."""
+
+    def __init__(self, rpm: int, tpm: int, max_inflight: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._inflight = asyncio.Semaphore(max_inflight)
+        # Les conversations en attente passent dans l'ordre d'arrivée
+        self._admission = asyncio.Lock()
+
+    async def acquire(self, tokens: int, requests: int = 1) -> None:
+        await self.reserve(tokens, requests)
+        await self._inflight.acquire()
+
+    async def reserve(self, tokens: int, requests: int = 1) -> None:
+        """Wait until the RPM/TPM budget allows the calls, then charge them."""
+        async with self._admission:
+            while True:
+                delay = max(self.requests.delay_for(requests), self.tokens.delay_for(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.consume(requests)
+            self.tokens.consume(tokens)
+
+    def release(self) -> None:
+        self._inflight.release()
+
+    def backoff(self, retry_after: float) -> None:
+        logger.warning("OpenAI rate limit reached, pausing new calls for %.1fs", retry_after)
+        self.requests.pause(retry_after)
+
+limiter = OpenAILimiter(OPENAI_RPM, OPENAI_TPM, OPENAI_MAX_INFLIGHT)
+
+# user_id -> [verrou, nombre de tâches qui l'utilisent]
+_user_locks = {}
+
+@asynccontextmanager
+async def user_turn(user_id):
+    """Process one update at a time per user, in arrival order."""
+    entry = _user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _user_locks[user_id]
+
+@asynccontextmanager
+async def chat_action(chat, action):
+    """Keep ``action`` displayed in ``chat`` until the block exits."""
+    async def refresh():
+        while True:
+            try:
+                await chat.send_action(action)
+            except Exception:
+                logger.debug("Could not send chat action", exc_info=True)
+            await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+    task = asyncio.create_task(refresh())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+def estimate_tokens(update: Update) -> int:
+    text = update.message.text or ""
+    return ESTIMATED_TURN_TOKENS + len(text) // 4
+
+def scheduled(handler, uses_openai: bool = True, action: str = ChatAction.TYPING):
+    """Wrap ``handler`` so it runs in order per user and within the OpenAI budget."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        with span(f'turn.{handler.__name__}'):
+            async with user_turn(update.effective_user.id):
+                if not uses_openai:
+                    await handler(update, context)
+                    return
+                async with chat_action(update.effective_chat, action):
+                    try:
+                        with span('scheduler.wait'):
+                            await asyncio.wait_for(limiter.acquire(estimate_tokens(update)), SCHEDULER_MAX_WAIT)
+                    except asyncio.TimeoutError:
+                        logger.warning("Shedding update from user %s after %ss in queue", update.effective_user.id, SCHEDULER_MAX_WAIT)
+                        await update.message.reply_text(BUSY_TEXT)
+                        return
+                    try:
+                        await handler(update, context)
+                    except asyncio.TimeoutError:
+                        # Délai de réponse d'OpenAI dépassé (COMPLETION_DEADLINE)
+                        logger.warning("No reply for user %s within the deadline", update.effective_user.id)
+                        await update.message.reply_text(TIMEOUT_TEXT)
+                    finally:
+                        limiter.release()
+    return wrapper
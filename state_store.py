@@ -0,0 +1,95 @@
+import json
+import os
+from collections import OrderedDict
+
+from sqlalchemy import delete
+
+from database import AsyncSession, UserState
+
+# "database" : partagé entre les process et conservé au redémarrage ; "memory" : local au process
+STATE_STORE = os.getenv('STATE_STORE', 'database')
+# Entrées gardées en mémoire devant la base
+STATE_CACHE_SIZE = int(os.getenv('STATE_CACHE_SIZE', 10000))
+
+class MemoryStateStore:
+    """Per-user conversation state kept in the process."""
+
+    def __init__(self):
+        self._values = {}
+
+    async def get(self, user_id, key: str, default=None, session=None):
+        return self._values.get((user_id, key), default)
+
+    async def set(self, user_id, key: str, value, session=None) -> None:
+        self._values[(user_id, key)] = value
+
+    async def delete(self, user_id, key: str, session=None) -> None:
+        self._values.pop((user_id, key), None)
+
+class DatabaseStateStore:
+    """Per-user conversation state in the ``user_states`` table, values as JSON.
+
+    Reads go through an LRU cache written through on every change. It stays
+    exact because a user's updates are always handled by the same process
+    (see the sharding in main.py).
+    """
+
+    def __init__(self, cache_size: int):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _remember(self, cache_key, value) -> None:
+        self._cache[cache_key] = value
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id, key: str, default=None, session=None):
+        """Read a value. ``session`` is the caller's session, to avoid checking out another connection."""
+        cache_key = (user_id, key)
+        if cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            value = self._cache[cache_key]
+        else:
+            if session is None:
+                async with AsyncSession() as session:
+                    row = await session.get(UserState, (user_id, key))
+            else:
+                row = await session.get(UserState, (user_id, key))
+            value = json.loads(row.value) if row else None
+            self._remember(cache_key, value)
+        return default if value is None else value
+
+    async def set(self, user_id, key: str, value, session=None) -> None:
+        """Write a value. With ``session``, it is written in the caller's transaction."""
+        await self._write(session, (user_id, key), value, UserState(user_id=user_id, key=key, value=json.dumps(value)))
+
+    async def delete(self, user_id, key: str, session=None) -> None:
+        await self._write(session, (user_id, key), None)
+
+    async def _write(self, session, cache_key, value, row=None) -> None:
+        if session is None:
+            async with AsyncSession() as session:
+                await self._apply(session, cache_key, row)
+                await session.commit()
+            self._remember(cache_key, value)
+            return
+        await self._apply(session, cache_key, row)
+        # Le cache ne change qu'une fois la transaction de l'appelant validée
+        session.info.setdefault('on_commit', []).append(lambda: self._remember(cache_key, value))
+
+    async def _apply(self, session, cache_key, row) -> None:
+        if row is not None:
+            await session.merge(row)
+        else:
+            user_id, key = cache_key
+            await session.execute(delete(UserState).where(UserState.user_id == user_id, UserState.key == key))
+
+def create_state_store(kind: str):
+    if kind == 'memory':
+        return MemoryStateStore()
+    if kind == 'database':
+        return DatabaseStateStore(STATE_CACHE_SIZE)
+    raise ValueError(f"Unknown STATE_STORE: {kind}")
+
+state_store = create_state_store(STATE_STORE)
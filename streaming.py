@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram tolère environ une modification par seconde et par chat : on ne
+# modifie pas le message plus souvent que ça pendant le streaming.
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+async def _edit(sent: Message, text: str):
+    """Edit ``sent`` and return ``(applied, earliest time of the next edit)``."""
+    try:
+        await sent.edit_text(text)
+    except RetryAfter as e:
+        retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+        logger.warning("Telegram edit rate limit hit, retrying in %ss", retry_after)
+        return False, time.monotonic() + retry_after
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return True, time.monotonic() + STREAM_EDIT_INTERVAL
+
+async def _finalize(sent: Message, text: str) -> None:
+    # La dernière modification doit passer, quitte à attendre la fin du rate limit
+    while True:
+        applied, next_edit = await _edit(sent, text)
+        if applied:
+            return
+        await asyncio.sleep(max(0.0, next_edit - time.monotonic()))
+
+async def send_streamed_reply(message: Message, chunks: AsyncIterator[str]) -> str:
+    """Reply to ``message`` while ``chunks`` stream in and return the full text.
+
+    A first message is sent as soon as the first piece arrives, then edited in
+    place at most once every STREAM_EDIT_INTERVAL seconds. Replies longer than
+    Telegram's limit continue in a new message.
+    """
+    parts = []
+    full_text = ""
+    sent = None
+    offset = 0  # début du texte affiché dans le message courant
+    shown = ""
+    next_edit = 0.0
+
+    async for piece in chunks:
+        parts.append(piece)
+        full_text = "".join(parts)
+        current = full_text[offset:]
+
+        while len(current) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            if sent is None:
+                await message.reply_text(current[:TELEGRAM_MAX_MESSAGE_LENGTH])
+            else:
+                await _finalize(sent, current[:TELEGRAM_MAX_MESSAGE_LENGTH])
+            offset += TELEGRAM_MAX_MESSAGE_LENGTH
+            current = full_text[offset:]
+            sent = None
+
+        if sent is None:
+            if not current.strip():
+                continue
+            sent = await message.reply_text(current)
+            shown = current
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        elif current != shown and time.monotonic() >= next_edit:
+            applied, next_edit = await _edit(sent, current)
+            if applied:
+                shown = current
+
+    current = full_text[offset:]
+    if sent is None:
+        if current.strip():
+            await message.reply_text(current)
+    elif current != shown:
+        await _finalize(sent, current)
+
+    return full_text
@@ -1,19 +1,18 @@
 import os
-import asyncio
 import json
-import nest_asyncio
-from datetime import datetime, timezone
-import pytz
-import requests
-import aiohttp
+from datetime import datetime, timedelta, timezone
 from flask import Flask, request, redirect, jsonify
 import stripe
 from dotenv import load_dotenv
-from telegram import Bot
-from database import engine, Subscription, User, Message
-from flask_sslify import SSLify
+from database import Session, Subscription, User
+import stripe_events
+import rollups
+import quota
+from stripe_client import create_customer, create_checkout_session, open_checkout_url, checkout_values
+import metrics
+from profiler import profiler
+from telegram_sender import telegram_sender
 import logging
-from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
 
 # Charger les variables d'environnement à partir du fichier .env
@@ -23,20 +22,11 @@ app = Flask(__name__)
 
 ENV = os.getenv('FLASK_ENV')
 
-if ENV == "prod":
-    sslify = SSLify(app)
-
-stripe.api_key = os.getenv('STRIPE_API_KEY')
-PRODUCT_ID = os.getenv('PRODUCT_ID')
-DOMAIN = os.getenv('DOMAIN')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_BOT_USERNAME = os.getenv('TELEGRAM_BOT_USERNAME')
 STRIPE_ENDPOINT_SECRET = os.getenv('STRIPE_ENDPOINT_SECRET')
-nest_asyncio.apply()
-
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-
-Session = sessionmaker(bind=engine)
+# Jeton demandé par /stats (en-tête Authorization: Bearer) ; la route est fermée sans lui
+STATS_TOKEN = os.getenv('STATS_TOKEN')
 
 @contextmanager
 def session_scope():
@@ -50,16 +40,9 @@ def session_scope():
     finally:
         session.close()
 
-# Fonction asynchrone pour envoyer un message Telegram
-def send_telegram_message(chat_id, text):
-    bot_token = TELEGRAM_BOT_TOKEN
-    telegram_url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
-
-    with session_scope() as session:
-        user_msg = Message(user_id=chat_id, message=text, is_sent_by_user=False)
-        session.add(user_msg)
-
-    requests.post(telegram_url, data={'chat_id': chat_id, 'text': text})
+# Envoi en arrière-plan : la requête HTTP n'attend pas Telegram
+def send_telegram_message(chat_id, text, log=True):
+    telegram_sender.send(chat_id, text, log=log)
 
 @app.route('/', methods=['GET'])
 def redirect_to_telegram():
@@ -67,55 +50,6 @@ def redirect_to_telegram():
     app.logger.info("redirect")
     return redirect(f'https://t.me/{TELEGRAM_BOT_USERNAME}?start=start')
 
-def create_checkout_session(user_id):
-    try:
-        app.logger.info("route pay")
-
-        if not user_id:
-            raise ValueError("user_id is required")
-
-        app.logger.info("userId: %s", user_id)
-
-        with session_scope() as session:
-            # Vérifier si l'utilisateur existe
-            user = session.query(User).filter_by(user_id=user_id).first()
-            if not user:
-                raise ValueError("User not found")
-
-            # Créer un client Stripe si l'utilisateur n'a pas encore de stripe_customer_id
-            if not user.stripe_customer_id:
-                app.logger.info("no stripe customer id")
-                customer = stripe.Customer.create(metadata={"user_id": user_id})
-                user.stripe_customer_id = customer.id
-                app.logger.info("new stripe customer id: %s", customer.id)
-
-            # Préparer les paramètres pour la création de la session Stripe
-            checkout_session_params = {
-                'payment_method_types': ['card'],
-                'line_items': [{
-                    'price': PRODUCT_ID,
-                    'quantity': 1,
-                }],
-                'mode': 'subscription',
-                'success_url': f'https://{DOMAIN}/success?session_id={{CHECKOUT_SESSION_ID}}&user_id={user_id}',
-                'cancel_url': f'https://{DOMAIN}/cancel?user_id={user_id}',
-                'customer': user.stripe_customer_id
-            }
-
-        # Créer la session de paiement
-        checkout_session = stripe.checkout.Session.create(**checkout_session_params)
-
-        return jsonify({
-            'id': checkout_session.id,
-            'url': checkout_session.url
-        })
-
-    except Exception as e:
-        app.logger.error("An error occurred: %s", str(e))
-        response = jsonify({'error': str(e)})
-        response.status_code = 500
-        return response
-
 @app.route('/redirect_to_stripe', methods=['GET'])
 def redirect_to_stripe():
     user_id = request.args.get('user_id')
@@ -123,37 +57,47 @@ def redirect_to_stripe():
     with session_scope() as session:
         # Vérifier si l'utilisateur existe
         user = session.query(User).filter_by(user_id=user_id).first()
-        app.logger.info("user")
-        app.logger.info(user)
         if not user:
-            send_telegram_message(chat_id=user_id, text="Unknown user")
+            send_telegram_message(chat_id=user_id, text="Unknown user", log=False)
             return redirect(f'https://t.me/{TELEGRAM_BOT_USERNAME}')
-        
-        # Récupérer l'enregistrement de l'abonnement le plus récent pour l'utilisateur
-        subscription = session.query(Subscription)\
-            .filter_by(user_id=user_id)\
-            .order_by(Subscription.created_at.desc())\
-            .first()
-        app.logger.info("subscription")
-        app.logger.info(subscription)
-
-        # Vérifier si l'utilisateur a déjà un abonnement actif (end_date dans le futur)
-        if subscription and subscription.end_date and subscription.end_date > datetime.now():
+
+        # Même règle que le bot : date de fin tenue à jour sur la ligne de l'utilisateur, en UTC
+        if quota.is_subscription_active(user.subscription_end_date):
             app.logger.info("user already subscribed")
             # Rediriger vers le bot Telegram et envoyer un message
-            send_telegram_message(user_id, "You already have a subscription")
+            send_telegram_message(user_id, quota.ALREADY_SUBSCRIBED_TEXT)
             return redirect(f'https://t.me/{TELEGRAM_BOT_USERNAME}')
 
-    response = create_checkout_session(user_id)
-    session_url = response.json.get('url')
-    return redirect(session_url)
+        # Un second clic sur « Continue chatting » renvoie vers la même session
+        checkout_url = open_checkout_url(user)
+        if checkout_url:
+            return redirect(checkout_url)
+        customer_id = user.stripe_customer_id
+
+    # Appels à Stripe hors transaction : aucune connexion n'est gardée pendant ce temps
+    try:
+        if not customer_id:
+            app.logger.info("no stripe customer id for user %s", user_id)
+            customer_id = create_customer(user_id)
+        checkout_session = create_checkout_session(user_id, customer_id)
+    except stripe.error.StripeError as e:
+        app.logger.error("Could not create the checkout session of %s: %s", user_id, str(e))
+        response = jsonify({'error': str(e)})
+        response.status_code = 500
+        return response
+
+    with session_scope() as session:
+        session.query(User).filter_by(user_id=user_id).update(
+            checkout_values(customer_id, checkout_session), synchronize_session=False
+        )
+    return redirect(checkout_session.url)
 
 @app.route('/success', methods=['GET'])
 def payment_success():
     user_id = request.args.get('user_id')
 
     # Envoyer un message de succès à l'utilisateur Telegram
-    send_telegram_message(chat_id=user_id, text="Your payment was successful.")
+    send_telegram_message(chat_id=user_id, text=quota.PAYMENT_SUCCESS_TEXT)
 
     return redirect(f'https://t.me/{TELEGRAM_BOT_USERNAME}')
 
@@ -162,7 +106,7 @@ def payment_cancel():
     user_id = request.args.get('user_id')
 
     # Envoyer un message d'annulation à l'utilisateur Telegram
-    send_telegram_message(chat_id=user_id, text="Your payment has been canceled. If you wish to continue using the service, please try again.")
+    send_telegram_message(chat_id=user_id, text=quota.PAYMENT_CANCELED_TEXT)
     
     return redirect(f'https://t.me/{TELEGRAM_BOT_USERNAME}')
 
@@ -186,82 +130,117 @@ def create_customer_portal_session():
 
     return redirect(portal_session.url)
 
+@app.route('/stats', methods=['GET'])
+def usage_stats():
+    if not STATS_TOKEN or request.headers.get('Authorization') != f"Bearer {STATS_TOKEN}":
+        return "Unauthorized", 401
+    days = request.args.get('days', 30, type=int)
+    until = rollups.today() + timedelta(days=1)
+    # Lecture des seuls agrégats : aucune requête sur les tables du bot
+    with session_scope() as session:
+        report = rollups.report(session, until - timedelta(days=days), until)
+    return jsonify({'days': report})
+
 @app.route('/webhook', methods=['POST'])
 def webhook_received():
     webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
-    request_data = json.loads(request.data)
+    payload = request.get_data()
 
     if webhook_secret:
         # Retrieve the event by verifying the signature using the raw body and secret if webhook signing is configured.
         signature = request.headers.get('stripe-signature')
         try:
             event = stripe.Webhook.construct_event(
-                payload=request.data, sig_header=signature, secret=webhook_secret)
-            data = event['data']
-        except Exception as e:
-            return e
-        # Get the type of webhook event sent - used to check the status of PaymentIntents.
-        event_type = event['type']
+                payload=payload, sig_header=signature, secret=webhook_secret)
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            app.logger.warning("Invalid Stripe webhook: %s", str(e))
+            return jsonify({'error': 'invalid payload'}), 400
     else:
-        data = request_data['data']
-        event_type = request_data['type']
-    data_object = data['object']
+        event = json.loads(payload)
+
+    event_type = event['type']
+    app.logger.info("event %s %s", event['id'], event_type)
 
-    print('event ' + event_type)
+    # L'événement est enregistré puis appliqué en arrière-plan : Stripe reçoit
+    # sa réponse tout de suite et une relivraison n'est jamais rejouée.
+    if not stripe_events.record(event['id'], event_type, payload.decode('utf-8')):
+        return jsonify({'status': 'duplicate'})
 
-    if event_type == 'invoice.paid':
-        handle_invoice_paid(data_object)
-        
     return jsonify({'status': 'success'})
 
-def handle_invoice_paid(data_object):
+def handle_invoice_paid(session, data_object):
     # Récupérer l'ID du client Stripe
     stripe_customer_id = data_object['customer']
-    
-    with session_scope() as session:
-        # Récupérer l'utilisateur associé à cet ID de client Stripe
-        user = session.query(User).filter_by(stripe_customer_id=stripe_customer_id).first()
-
-        if user:
-            # Récupérer la ligne d'abonnement de la facture
-            line_item = data_object['lines']['data'][0]
-            
-            # Récupérer les dates de début et de fin de la période de facturation
-            start_date_timestamp = line_item['period']['start']
-            end_date_timestamp = line_item['period']['end']
-
-            # Convertir les timestamps en datetime UTC
-            start_date = datetime.fromtimestamp(start_date_timestamp, tz=timezone.utc)
-            end_date = datetime.fromtimestamp(end_date_timestamp, tz=timezone.utc)
-
-            print(start_date)
-            print(end_date)
-
-            # Créer une nouvelle entrée dans la table subscriptions
-            new_subscription = Subscription(
-                user_id=user.user_id,
-                start_date=start_date,
-                end_date=end_date
-            )
-
-            # Ajouter et valider la nouvelle entrée
-            session.add(new_subscription)
-            print(f'🔔 Subscription created for user_id: {user.user_id}')
-
-        else:
-            print(f'User not found for stripe_customer_id: {stripe_customer_id}')
-
-print("Starting application...")
-
-# Configurer le logger pour envoyer les messages à stdout
-if __name__ != "__main__":
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+
+    # Récupérer l'utilisateur associé à cet ID de client Stripe
+    user = session.query(User).filter_by(stripe_customer_id=stripe_customer_id).first()
+
+    if not user:
+        app.logger.warning("User not found for stripe_customer_id: %s", stripe_customer_id)
+        return
+
+    # Premier paiement de l'utilisateur : compté comme une conversion
+    first_payment = session.query(Subscription.id).filter_by(user_id=user.user_id).first() is None
+
+    # Récupérer la ligne d'abonnement de la facture
+    line_item = data_object['lines']['data'][0]
+
+    # Récupérer les dates de début et de fin de la période de facturation
+    start_date_timestamp = line_item['period']['start']
+    end_date_timestamp = line_item['period']['end']
+
+    # Convertir les timestamps en datetime UTC
+    start_date = datetime.fromtimestamp(start_date_timestamp, tz=timezone.utc)
+    end_date = datetime.fromtimestamp(end_date_timestamp, tz=timezone.utc)
+
+    # Créer une nouvelle entrée dans la table subscriptions
+    new_subscription = Subscription(
+        user_id=user.user_id,
+        start_date=start_date,
+        end_date=end_date
+    )
+    session.add(new_subscription)
+    rollups.record(session, user.user_id, payments=1, conversions=int(first_payment))
+    # La session de paiement est consommée : le prochain paiement en ouvrira une nouvelle
+    user.checkout_session_url = None
+    user.checkout_session_expires_at = None
+    # Lue par le bot avec l'utilisateur à chaque tour : le paiement compte dès le commit
+    paid_until = end_date.replace(tzinfo=None)
+    if user.subscription_end_date is None or user.subscription_end_date < paid_until:
+        user.subscription_end_date = paid_until
+    app.logger.info("🔔 Subscription created for user_id: %s (%s - %s)", user.user_id, start_date, end_date)
+
+stripe_events.register('invoice.paid', handle_invoice_paid)
+
+def create_app() -> Flask:
+    """Configure the app once and return it.
+
+    Nothing here connects or starts a thread, so the app can be loaded in the
+    gunicorn master: `gunicorn --preload 'stripe_checkout:create_app()'`.
+    """
+    if app.config.get('CONFIGURED'):
+        return app
+    app.config['CONFIGURED'] = True
+
+    if ENV == "prod":
+        from flask_sslify import SSLify
+        SSLify(app)
+
+    metrics.instrument(app)
+    # Démarrés à la première requête de chaque worker gunicorn, après le fork
+    app.before_request(profiler.start)
+    app.before_request(stripe_events.start)
+
+    # Configurer le logger pour envoyer les messages à stdout
+    if __name__ != "__main__":
+        gunicorn_logger = logging.getLogger('gunicorn.error')
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+    return app
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 3000))
     print(f"Running Flask application on port {port}...", flush=True)
-    app.run(host='0.0.0.0', port=port)
+    create_app().run(host='0.0.0.0', port=port)
 
     
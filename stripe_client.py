@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+import requests
+import stripe
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from sqlalchemy import func, update
+
+from database import AsyncSession, User
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_ID = os.getenv('PRODUCT_ID')
+DOMAIN = os.getenv('DOMAIN')
+# Délais (s) de connexion et de lecture des appels à l'API Stripe
+STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', 3))
+STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT', 10))
+STRIPE_MAX_RETRIES = int(os.getenv('STRIPE_MAX_RETRIES', 2))
+STRIPE_POOL_SIZE = int(os.getenv('STRIPE_POOL_SIZE', 10))
+# Une session de paiement n'est réutilisée que s'il lui reste au moins ce délai (s)
+CHECKOUT_SESSION_MIN_LIFETIME = float(os.getenv('CHECKOUT_SESSION_MIN_LIFETIME', 3600))
+
+stripe.api_key = os.getenv('STRIPE_API_KEY')
+stripe.max_network_retries = STRIPE_MAX_RETRIES
+
+# Connexions TLS vers l'API gardées ouvertes entre les requêtes, avec des délais
+# bornés : un Stripe lent ne bloque pas un worker gunicorn indéfiniment.
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_POOL_SIZE))
+http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_POOL_SIZE))
+stripe.default_http_client = stripe.RequestsClient(
+    session=http,
+    timeout=(STRIPE_CONNECT_TIMEOUT, STRIPE_READ_TIMEOUT),
+)
+
+def create_customer(user_id) -> str:
+    """Create the Stripe customer of the user and return its id.
+
+    The idempotency key makes concurrent calls for the same user (the
+    background provisioning and a checkout) return the same customer.
+    """
+    customer = stripe.Customer.create(metadata={"user_id": user_id}, idempotency_key=f"customer-{user_id}")
+    return customer.id
+
+def create_checkout_session(user_id, customer_id):
+    """Create the subscription Checkout session of the user and return it."""
+    return stripe.checkout.Session.create(
+        payment_method_types=['card'],
+        line_items=[{
+            'price': PRODUCT_ID,
+            'quantity': 1,
+        }],
+        mode='subscription',
+        success_url=f'https://{DOMAIN}/success?session_id={{CHECKOUT_SESSION_ID}}&user_id={user_id}',
+        cancel_url=f'https://{DOMAIN}/cancel?user_id={user_id}',
+        customer=customer_id,
+    )
+
+def open_checkout_url(user):
+    """Return the user's cached Checkout URL if it is still valid for a while."""
+    expires_at = user.checkout_session_expires_at
+    if not user.checkout_session_url or expires_at is None:
+        return None
+    if expires_at - datetime.utcnow() < timedelta(seconds=CHECKOUT_SESSION_MIN_LIFETIME):
+        return None
+    return user.checkout_session_url
+
+def checkout_values(customer_id, checkout_session) -> dict:
+    """Column values storing the customer and the Checkout session on ``users``."""
+    return {
+        # Un client déjà enregistré (par le provisionnement en arrière-plan) est gardé
+        User.stripe_customer_id: func.coalesce(User.stripe_customer_id, customer_id),
+        User.checkout_session_url: checkout_session.url,
+        User.checkout_session_expires_at: datetime.utcfromtimestamp(checkout_session.expires_at),
+    }
+
+_tasks = set()
+
+def schedule_customer(user_id) -> None:
+    """Create the user's Stripe customer in the background, ahead of the paywall."""
+    task = asyncio.create_task(provision_customer(user_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def provision_customer(user_id) -> None:
+    try:
+        customer_id = await asyncio.to_thread(create_customer, user_id)
+        async with AsyncSession() as session:
+            await session.execute(
+                update(User)
+                .where(User.user_id == user_id, User.stripe_customer_id.is_(None))
+                .values(stripe_customer_id=customer_id)
+            )
+            await session.commit()
+    except Exception:
+        # Le client sera créé au moment du paiement
+        logger.warning("Could not provision the Stripe customer of %s", user_id, exc_info=True)
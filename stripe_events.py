@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from database import Session, ProcessedEvent
+
+logger = logging.getLogger(__name__)
+
+# Nombre maximum d'événements appliqués dans une même transaction
+STRIPE_EVENTS_BATCH_SIZE = int(os.getenv('STRIPE_EVENTS_BATCH_SIZE', 50))
+# Les événements restés en attente (redémarrage, erreur) sont réessayés à cet intervalle (s)
+STRIPE_EVENTS_RETRY_INTERVAL = float(os.getenv('STRIPE_EVENTS_RETRY_INTERVAL', 60))
+
+# event_type -> fonction(session, data_object) qui applique l'événement
+_handlers = {}
+_queue = queue.Queue()
+_worker_lock = threading.Lock()
+_worker_pid = None
+
+def register(event_type, handler) -> None:
+    _handlers[event_type] = handler
+
+def record(event_id, event_type, payload: str) -> bool:
+    """Store the event and queue it. Returns False if it was already received."""
+    handled = event_type in _handlers
+    session = Session()
+    try:
+        session.add(ProcessedEvent(
+            event_id=event_id,
+            event_type=event_type,
+            payload=payload,
+            processed_at=None if handled else datetime.utcnow(),
+        ))
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return False
+    finally:
+        session.close()
+
+    if handled:
+        start()
+        _queue.put(event_id)
+    return True
+
+def start() -> None:
+    """Start this process's worker thread if it is not running yet."""
+    # Un thread par process, démarré après le fork de gunicorn
+    global _worker_pid
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        _worker_pid = os.getpid()
+        threading.Thread(target=_run, name='stripe-events', daemon=True).start()
+
+def _run() -> None:
+    while True:
+        # Événements reçus mais pas appliqués (redémarrage, erreur d'un handler)
+        try:
+            _process_pending()
+        except Exception:
+            logger.exception("Could not apply pending Stripe events")
+
+        deadline = time.monotonic() + STRIPE_EVENTS_RETRY_INTERVAL
+        while time.monotonic() < deadline:
+            try:
+                event_ids = [_queue.get(timeout=max(0.0, deadline - time.monotonic()))]
+            except queue.Empty:
+                break
+            while len(event_ids) < STRIPE_EVENTS_BATCH_SIZE:
+                try:
+                    event_ids.append(_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                process_batch(event_ids)
+            except Exception:
+                logger.exception("Could not apply Stripe events %s", event_ids)
+
+def _process_pending() -> None:
+    session = Session()
+    try:
+        pending = [row.event_id for row in session.query(ProcessedEvent.event_id).filter(ProcessedEvent.processed_at.is_(None))]
+    finally:
+        session.close()
+    for first in range(0, len(pending), STRIPE_EVENTS_BATCH_SIZE):
+        process_batch(pending[first:first + STRIPE_EVENTS_BATCH_SIZE])
+
+def process_batch(event_ids) -> None:
+    """Apply the given events in one transaction, each in its own savepoint."""
+    session = Session()
+    try:
+        events = (
+            session.query(ProcessedEvent)
+            .filter(ProcessedEvent.event_id.in_(event_ids), ProcessedEvent.processed_at.is_(None))
+            .order_by(ProcessedEvent.received_at)
+            .with_for_update()
+            .all()
+        )
+        for event in events:
+            try:
+                with session.begin_nested():
+                    data_object = json.loads(event.payload)['data']['object']
+                    _handlers[event.event_type](session, data_object)
+                    event.processed_at = datetime.utcnow()
+            except Exception:
+                # Reste en attente : réessayé au prochain passage sur les événements en attente
+                logger.exception("Could not apply Stripe event %s", event.event_id)
+        session.commit()
+        for callback in session.info.pop('on_commit', []):
+            callback()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
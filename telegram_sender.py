@@ -0,0 +1,184 @@
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import insert
+
+from database import Session, Message
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org')
+# Limites d'envoi de Telegram : ~30 messages/s au total, 1 message/s par chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', 1.0))
+TELEGRAM_SEND_RETRIES = int(os.getenv('TELEGRAM_SEND_RETRIES', 5))
+TELEGRAM_SEND_TIMEOUT = float(os.getenv('TELEGRAM_SEND_TIMEOUT', 10))
+# Les messages envoyés sont enregistrés en base par lots
+TELEGRAM_LOG_BATCH_SIZE = int(os.getenv('TELEGRAM_LOG_BATCH_SIZE', 100))
+# À l'arrêt d'un worker, temps laissé pour envoyer les messages encore en file
+TELEGRAM_DRAIN_TIMEOUT = float(os.getenv('TELEGRAM_DRAIN_TIMEOUT', 10))
+
+class TelegramSender:
+    """Send Telegram messages from a background thread over pooled connections.
+
+    ``send`` only enqueues; the sender thread spaces messages to respect the
+    global and per-chat limits, retries with backoff and logs the delivered
+    messages in bulk.
+    """
+
+    def __init__(self, token: str, base_url: str):
+        self.url = f"{base_url}/bot{token}/sendMessage"
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._sequence = itertools.count()
+        # (instant d'envoi au plus tôt, ordre, message) : file triée par échéance
+        self._scheduled = []
+        self._next_global = 0.0
+        self._next_per_chat = {}
+        self._to_log = []
+
+    def send(self, chat_id, text: str, log: bool = True) -> None:
+        self._ensure_thread()
+        self._queue.put((chat_id, text, log))
+
+    def _ensure_thread(self) -> None:
+        # Un thread par process, démarré après le fork de gunicorn
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='telegram-sender', daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        """Send what is still queued and log it, within TELEGRAM_DRAIN_TIMEOUT."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+        self._queue.put(None)
+        self._thread.join(TELEGRAM_DRAIN_TIMEOUT + TELEGRAM_SEND_TIMEOUT)
+
+    def _run(self) -> None:
+        while True:
+            timeout = None
+            if self._scheduled:
+                timeout = max(0.0, self._scheduled[0][0] - time.monotonic())
+            elif self._to_log:
+                timeout = 0.0
+            try:
+                item = self._queue.get(timeout=timeout) if timeout != 0.0 else self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                if item is None:
+                    self._drain()
+                    return
+                self._schedule(item)
+                continue
+
+            if self._scheduled and self._scheduled[0][0] <= time.monotonic():
+                _, _, item = heapq.heappop(self._scheduled)
+                self._deliver(item)
+            elif not self._scheduled:
+                self._flush_log()
+
+    def _drain(self) -> None:
+        deadline = time.monotonic() + TELEGRAM_DRAIN_TIMEOUT
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self._schedule(item)
+        while self._scheduled and time.monotonic() < deadline:
+            send_at, _, item = heapq.heappop(self._scheduled)
+            time.sleep(max(0.0, send_at - time.monotonic()))
+            self._deliver(item)
+        for _, _, (chat_id, text, _) in self._scheduled:
+            logger.error("Worker exiting, message to %s not sent: %r", chat_id, text)
+        self._scheduled = []
+        self._flush_log()
+
+    def _schedule(self, item) -> None:
+        chat_id = item[0]
+        now = time.monotonic()
+        send_at = max(now, self._next_global, self._next_per_chat.get(chat_id, 0.0))
+        self._next_global = send_at + 1.0 / TELEGRAM_GLOBAL_RATE
+        self._next_per_chat[chat_id] = send_at + TELEGRAM_CHAT_INTERVAL
+        heapq.heappush(self._scheduled, (send_at, next(self._sequence), item))
+        # Oublier les chats inactifs
+        if len(self._next_per_chat) > 10000:
+            self._next_per_chat = {k: v for k, v in self._next_per_chat.items() if v > now}
+
+    def _deliver(self, item) -> None:
+        chat_id, text, log = item
+        for attempt in range(TELEGRAM_SEND_RETRIES):
+            try:
+                response = self.http.post(self.url, data={'chat_id': chat_id, 'text': text}, timeout=TELEGRAM_SEND_TIMEOUT)
+            except requests.RequestException:
+                logger.warning("Telegram send to %s failed (attempt %s)", chat_id, attempt + 1, exc_info=True)
+                time.sleep(0.5 * 2 ** attempt)
+                continue
+
+            if response.status_code == 200:
+                if log:
+                    self._to_log.append({'user_id': chat_id, 'message': text, 'is_sent_by_user': False})
+                    if len(self._to_log) >= TELEGRAM_LOG_BATCH_SIZE:
+                        self._flush_log()
+                return
+            if response.status_code == 429:
+                try:
+                    retry_after = response.json().get('parameters', {}).get('retry_after', 1)
+                except ValueError:
+                    retry_after = 1
+                logger.warning("Telegram rate limit, retrying in %ss", retry_after)
+                time.sleep(retry_after)
+            elif response.status_code >= 500:
+                time.sleep(0.5 * 2 ** attempt)
+            else:
+                logger.error("Telegram refused message to %s: %s", chat_id, response.text)
+                return
+        logger.error("Giving up sending message to %s", chat_id)
+
+    def _flush_log(self) -> None:
+        rows, self._to_log = self._to_log, []
+        if not rows:
+            return
+        session = Session()
+        try:
+            try:
+                session.execute(insert(Message), rows)
+                session.commit()
+                return
+            except Exception:
+                session.rollback()
+                logger.warning("Could not log %s sent messages in bulk, logging them one by one", len(rows), exc_info=True)
+            # Une ligne invalide (user_id inconnu...) ne fait pas perdre les autres
+            for row in rows:
+                try:
+                    session.execute(insert(Message), [row])
+                    session.commit()
+                except Exception:
+                    session.rollback()
+                    logger.exception("Could not log message sent to %s", row['user_id'])
+        finally:
+            session.close()
+
+telegram_sender = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_API_BASE_URL)
+# Les workers gunicorn héritent de l'enregistrement ; close ne fait rien dans le master
+atexit.register(telegram_sender.close)
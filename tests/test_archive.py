@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from archive import archive_chunk, read_history
+from database import Base, ConversationSummary, Message, MessageArchive, User
+from history_cache import HISTORY_TURNS
+
+def make_session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    return sessionmaker(engine)()
+
+def add_messages(session, user_id, count, created_at):
+    session.add(User(user_id=user_id, username=f"user{user_id}", message_count=count, message_batch=0))
+    session.add_all(
+        Message(user_id=user_id, message=f"message {i}", is_sent_by_user=i % 2 == 0, created_at=created_at)
+        for i in range(count)
+    )
+    session.commit()
+
+def test_archives_users_without_summary_but_keeps_their_latest_turns():
+    session = make_session()
+    old = datetime.utcnow() - timedelta(days=365)
+    add_messages(session, 1, HISTORY_TURNS + 5, old)
+
+    assert session.get(ConversationSummary, 1) is None
+    assert archive_chunk(session, datetime.utcnow() - timedelta(days=180), 1000) == 5
+
+    kept = session.scalars(select(Message.message).filter_by(user_id=1).order_by(Message.id)).all()
+    assert kept == [f"message {i}" for i in range(5, HISTORY_TURNS + 5)]
+    assert session.scalar(select(func.sum(MessageArchive.message_count))) == 5
+    assert [record['message'] for record in read_history(session, 1)] == [f"message {i}" for i in range(HISTORY_TURNS + 5)]
+
+def test_keeps_every_message_of_short_histories():
+    session = make_session()
+    add_messages(session, 1, HISTORY_TURNS, datetime.utcnow() - timedelta(days=365))
+
+    assert archive_chunk(session, datetime.utcnow() - timedelta(days=180), 1000) == 0
+    assert session.scalar(select(func.count(Message.id))) == HISTORY_TURNS
+
+def test_keeps_recent_messages():
+    session = make_session()
+    add_messages(session, 1, HISTORY_TURNS + 5, datetime.utcnow())
+
+    assert archive_chunk(session, datetime.utcnow() - timedelta(days=180), 1000) == 0
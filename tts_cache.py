@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Limites des deux niveaux du cache, en octets
+TTS_CACHE_MEMORY_BYTES = int(os.getenv('TTS_CACHE_MEMORY_BYTES', 32 * 1024 * 1024))
+TTS_CACHE_DISK_BYTES = int(os.getenv('TTS_CACHE_DISK_BYTES', 512 * 1024 * 1024))
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', '.tts_cache')
+# Nombre de file_id Telegram conservés
+TTS_CACHE_MAX_FILE_IDS = int(os.getenv('TTS_CACHE_MAX_FILE_IDS', 50000))
+
+def cache_key(text: str, voice: str, model: str, response_format: str) -> str:
+    return hashlib.sha256("\0".join((text, voice, model, response_format)).encode()).hexdigest()
+
+class TTSCache:
+    """Synthesized speech keyed by content hash, in memory and on disk (both LRU).
+
+    Also remembers the Telegram ``file_id`` of each uploaded voice message so a
+    repeated utterance can be sent again without uploading the audio.
+    """
+
+    def __init__(self, memory_bytes: int, disk_bytes: int, directory: str, max_file_ids: int):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.max_file_ids = max_file_ids
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()  # key -> taille, du moins au plus récemment utilisé
+        self._disk_size = 0
+        self._file_ids = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+        # Index du disque lu à la première utilisation, pas au démarrage
+        self._index_task = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _scan_disk(self) -> list:
+        if not self.disk_bytes or not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        return sorted(entries)
+
+    async def _load_disk_index(self) -> None:
+        for _, key, size in await asyncio.to_thread(self._scan_disk):
+            self._disk[key] = size
+            self._disk_size += size
+
+    async def _ensure_index(self) -> None:
+        if self._index_task is None:
+            self._index_task = asyncio.ensure_future(self._load_disk_index())
+        await self._index_task
+
+    def get_file_id(self, key: str):
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.file_id_hits += 1
+        return file_id
+
+    def set_file_id(self, key: str, file_id: str) -> None:
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+
+    async def get(self, key: str):
+        audio = self._memory.get(key)
+        if audio is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return audio
+        await self._ensure_index()
+        if key in self._disk:
+            # Seules les lectures/écritures de fichiers passent par un thread,
+            # les index sont modifiés depuis la boucle d'événements.
+            audio = await asyncio.to_thread(self._read_file, key)
+            if audio is not None:
+                self._disk.move_to_end(key)
+                self.disk_hits += 1
+                self._put_memory(key, audio)
+                return audio
+            self._disk_size -= self._disk.pop(key, 0)
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, audio: bytes) -> None:
+        self._put_memory(key, audio)
+        await self._ensure_index()
+        if not self.disk_bytes or len(audio) > self.disk_bytes or key in self._disk:
+            return
+        if not await asyncio.to_thread(self._write_file, key, audio) or key in self._disk:
+            return
+        self._disk[key] = len(audio)
+        self._disk_size += len(audio)
+        evicted = []
+        while self._disk_size > self.disk_bytes:
+            evicted_key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            evicted.append(evicted_key)
+        if evicted:
+            await asyncio.to_thread(self._remove_files, evicted)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'file_id_hits': self.file_id_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_bytes': self._memory_size,
+            'disk_bytes': self._disk_size,
+        }
+
+    def _put_memory(self, key: str, audio: bytes) -> None:
+        if len(audio) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = audio
+        self._memory_size += len(audio)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _read_file(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            os.utime(path)
+            return audio
+        except FileNotFoundError:
+            return None
+
+    def _write_file(self, key: str, audio: bytes) -> bool:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(key)}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, self._path(key))
+            return True
+        except OSError:
+            logger.warning("Could not write TTS cache entry %s", key, exc_info=True)
+            return False
+
+    def _remove_files(self, keys) -> None:
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+tts_cache = TTSCache(TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_BYTES, TTS_CACHE_DIR, TTS_CACHE_MAX_FILE_IDS)
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import re
+from typing import AsyncIterator, Awaitable, Callable
+
+from openai_client import create_speech, speech_cache_key
+from tts_cache import tts_cache
+from metrics import span
+
+# Nombre maximum de synthèses vocales en parallèle pour une même réponse
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', 3))
+# Longueur minimale d'un segment, pour ne pas envoyer une note vocale par « Oui. »
+TTS_MIN_SEGMENT_CHARS = int(os.getenv('TTS_MIN_SEGMENT_CHARS', 40))
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…])\s+')
+
+async def split_sentences(chunks: AsyncIterator[str], min_chars: int = TTS_MIN_SEGMENT_CHARS) -> AsyncIterator[str]:
+    """Regroup streamed text into segments that end on a sentence boundary."""
+    buffer = ""
+    async for piece in chunks:
+        buffer += piece
+        while True:
+            boundary = next((m for m in SENTENCE_BOUNDARY.finditer(buffer) if m.start() >= min_chars), None)
+            if boundary is None:
+                break
+            segment = buffer[:boundary.start()].strip()
+            buffer = buffer[boundary.end():]
+            if segment:
+                yield segment
+    if buffer.strip():
+        yield buffer.strip()
+
+async def send_voice_cached(text: str, voice, send_voice: Callable[[object], Awaitable]) -> None:
+    with span('telegram.send_voice'):
+        sent = await send_voice(voice)
+    if isinstance(voice, bytes) and sent is not None and sent.voice is not None:
+        tts_cache.set_file_id(speech_cache_key(text), sent.voice.file_id)
+
+async def speak(text: str, send_voice: Callable[[object], Awaitable]) -> None:
+    """Send ``text`` as a single voice message, reusing a cached upload if any."""
+    voice = tts_cache.get_file_id(speech_cache_key(text)) or await create_speech(text)
+    await send_voice_cached(text, voice, send_voice)
+
+async def speak_pipelined(chunks: AsyncIterator[str], send_voice: Callable[[object], Awaitable]) -> str:
+    """Synthesize the reply sentence by sentence while it is generated.
+
+    Up to TTS_CONCURRENCY segments are synthesized at once and each voice
+    message is passed to ``send_voice`` in reply order as soon as it is ready.
+    Returns the full reply text.
+    """
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+    pending = asyncio.Queue()
+    parts = []
+
+    async def recorded():
+        async for piece in chunks:
+            parts.append(piece)
+            yield piece
+
+    async def synthesize(segment):
+        async with semaphore:
+            return await create_speech(segment)
+
+    async def prepare(segment):
+        # Déjà envoyé une fois : Telegram réutilise le fichier sans nouvel upload
+        file_id = tts_cache.get_file_id(speech_cache_key(segment))
+        if file_id is not None:
+            return segment, file_id
+        return segment, await synthesize(segment)
+
+    async def produce():
+        try:
+            async for segment in split_sentences(recorded()):
+                await pending.put(asyncio.create_task(prepare(segment)))
+        finally:
+            await pending.put(None)
+
+    producer = asyncio.create_task(produce())
+    tasks = []
+    try:
+        while True:
+            task = await pending.get()
+            if task is None:
+                break
+            tasks.append(task)
+            segment, voice = await task
+            await send_voice_cached(segment, voice, send_voice)
+        await producer
+    finally:
+        producer.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                tasks.append(task)
+        for task in tasks:
+            task.cancel()
+
+    return "".join(parts)